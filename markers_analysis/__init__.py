@@ -0,0 +1,8 @@
+# -*- coding:utf-8 -*-
+
+"""
+Analysis tools for the marker files saved by the markers plugin.
+"""
+
+from markers_analysis.marker_files import find_marker_files, read_marker_file, load_marker_files
+from markers_analysis.verification import read_trigger_channel, read_marker_table, detect_trigger_edges, verify_markers
@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+
+"""
+Loads the binary marker files saved by markers_os3_init (setting *Binary
+marker file*) of many subjects at once. The files are memory-mapped, so only
+the columns that are used are read from disk.
+
+Example:
+
+    from markers_analysis import load_marker_files
+    markers = load_marker_files('data/')
+    eeg_events = markers[markers.tag == 'eeg']
+"""
+
+import os
+import re
+import glob
+
+import numpy
+
+# File name of a binary marker file: subject-<nr>_<tag>_marker_data.<format>
+FILE_PATTERN = re.compile(r"^subject-(?P<subject>-?\d+)_(?P<tag>.+)_marker_data\.(?P<format>feather|parquet|npy)$")
+
+# Columns of a binary marker file
+COLUMNS = [('time_ms', 'f8'), ('value', 'i2'), ('write_start_ns', 'i8'), ('write_end_ns', 'i8'), ('error', 'i1')]
+
+
+def find_marker_files(path):
+
+    """
+    desc:
+        Returns the binary marker files in a folder (including subfolders).
+    """
+
+    files = glob.glob(os.path.join(path, '**', 'subject-*_marker_data.*'), recursive=True)
+    return sorted(file for file in files if FILE_PATTERN.match(os.path.basename(file)))
+
+
+def read_marker_file(path):
+
+    """
+    desc:
+        Returns the columns of a binary marker file as a dict of NumPy arrays,
+        memory-mapped from the file when possible.
+    """
+
+    extension = os.path.splitext(path)[1]
+    if extension == '.npy':
+        records = numpy.load(path, mmap_mode='r')
+        return {name: records[name] for name in records.dtype.names}
+
+    import pyarrow
+    if extension == '.feather':
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+    elif extension == '.parquet':
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path, memory_map=True)
+    else:
+        raise ValueError(f"Not a binary marker file: {path}")
+    return {name: table.column(name).to_numpy() for name in table.column_names}
+
+
+def load_marker_files(paths, as_dataframe=True):
+
+    """
+    desc:
+        Loads the binary marker files of many subjects and merges them into
+        one table with a subject and tag column (taken from the file names).
+
+    arguments:
+        paths:      A folder with marker files, or a list of marker files.
+        as_dataframe:
+                    Returns a pandas DataFrame when True, otherwise a dict of
+                    NumPy arrays.
+    """
+
+    if isinstance(paths, str):
+        paths = find_marker_files(paths) if os.path.isdir(paths) else [paths]
+
+    parts = []
+    subjects = []
+    tags = []
+    for path in paths:
+        match = FILE_PATTERN.match(os.path.basename(path))
+        columns = read_marker_file(path)
+        n_markers = len(columns['time_ms'])
+        parts.append(columns)
+        subjects.append(numpy.full(n_markers, int(match.group('subject')) if match else -1))
+        tags.append(numpy.full(n_markers, match.group('tag') if match else '', dtype=object))
+
+    # One concatenation per column, the memory-mapped columns are copied only here
+    markers = {}
+    for name, dtype in COLUMNS:
+        markers[name] = numpy.concatenate([part[name] for part in parts] or [numpy.empty(0, dtype)]).astype(
+            dtype, copy=False)
+    markers['subject'] = numpy.concatenate(subjects or [numpy.empty(0, int)])
+    markers['tag'] = numpy.concatenate(tags or [numpy.empty(0, object)])
+
+    if not as_dataframe:
+        return markers
+    import pandas
+    markers['tag'] = pandas.Categorical(markers['tag'])
+    return pandas.DataFrame(markers)
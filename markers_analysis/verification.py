@@ -0,0 +1,394 @@
+# -*- coding:utf-8 -*-
+
+"""
+Checks after a session that the markers sent by the markers plugin match the
+markers recorded by the amplifier in its trigger (status) channel. The edges
+in the trigger channel are detected with vectorized operations (in chunks,
+so memory-mapped recordings of many hours are not loaded at once), and the
+two sequences are aligned, also when markers are missing or when the
+recording was started late or stopped early.
+
+Example:
+
+    from markers_analysis import read_trigger_channel, verify_markers
+    trigger = read_trigger_channel('recording.raw', dtype='<i4', n_channels=33, channel=32)
+    result = verify_markers('subject-1_eeg_marker_table.tsv', trigger, sample_rate=2048, mask=0xFF)
+    print(result['summary'])
+    missing = result['markers'][result['markers'].status == 'missing']
+"""
+
+import os
+import io
+
+import numpy
+
+from markers_analysis.marker_files import read_marker_file
+
+# Status of a marker in the result of verify_markers
+STATUS_OK = 'ok'
+STATUS_WRONG_VALUE = 'wrong_value'
+STATUS_MISSING = 'missing'
+STATUS_NOT_RECORDED = 'not_recorded'
+
+# Number of samples of the trigger channel that are read at once
+CHUNK_SIZE = 1 << 22
+
+
+def read_trigger_channel(path, dtype='<i2', n_channels=1, channel=0, offset=0):
+
+    """
+    desc:
+        Returns the trigger channel of a raw recording file (samples of all
+        channels interleaved) as a memory-mapped NumPy array.
+
+    arguments:
+        path:       The raw recording file.
+        dtype:      The data type of the samples, e.g. '<i2' or '<i4'.
+        n_channels: The number of channels in the file.
+        channel:    The index of the trigger channel.
+        offset:     The size (bytes) of the header before the samples.
+    """
+
+    data = numpy.memmap(path, dtype=dtype, mode='r', offset=offset)
+    n_samples = len(data) // n_channels
+    return data[:n_samples * n_channels].reshape(n_samples, n_channels)[:, channel]
+
+
+def read_marker_table(path):
+
+    """
+    desc:
+        Returns the marker times (ms) and values of a marker file, as a dict
+        of NumPy arrays. The marker file is a marker table saved by
+        markers_os3_init (TSV, setting *Generate marker file*), a streaming
+        marker log (setting *Stream marker log*) or a binary marker file
+        (setting *Binary marker file*). Markers that could not be written
+        are left out.
+    """
+
+    if os.path.splitext(path)[1] != '.tsv':
+        columns = read_marker_file(path)
+        written = numpy.asarray(columns['error']) == 0
+        return {'time_ms': numpy.asarray(columns['time_ms'], dtype=float)[written],
+                'value': numpy.asarray(columns['value'], dtype=int)[written]}
+
+    import pandas
+
+    # The TSV file has several tables separated by empty lines, the marker
+    # table is the one with the marker times (the error table also has
+    # marker times, and a message column). The marker log has a type column.
+    with open(path) as f:
+        tables = f.read().split('\n\n')
+    for table in tables:
+        header = table.lstrip('\n').split('\n', 1)[0].split('\t')
+        if 'message' in header and 'type' not in header:
+            continue
+        if 'value' in header and ('start_time_s' in header or 'time_ms' in header):
+            return marker_arrays(pandas.read_csv(io.StringIO(table), sep='\t'))
+    raise ValueError(f"No marker table found in {path}")
+
+
+def marker_arrays(markers):
+
+    """
+    desc:
+        Returns the marker times (ms) and values of a marker table (a
+        DataFrame or dict of arrays, with time_ms or start_time_s column) as a
+        dict of NumPy arrays. With a type column (streaming marker log), only
+        the rows of type marker are used.
+    """
+
+    if 'type' in markers:
+        is_marker = numpy.asarray(markers['type']) == 'marker'
+        markers = {column: numpy.asarray(markers[column])[is_marker] for column in markers
+                   if column in ('time_ms', 'start_time_s', 'value')}
+    if 'time_ms' in markers:
+        time_ms = numpy.asarray(markers['time_ms'], dtype=float)
+    else:
+        time_ms = numpy.asarray(markers['start_time_s'], dtype=float) * 1000
+    return {'time_ms': time_ms, 'value': numpy.asarray(markers['value'], dtype=int)}
+
+
+def detect_trigger_edges(trigger, sample_rate, mask=None, min_samples=1, chunk_size=CHUNK_SIZE):
+
+    """
+    desc:
+        Returns the marker onsets in a trigger channel: the samples at which
+        the trigger value changes to a value other than 0.
+
+    arguments:
+        trigger:    The trigger channel, a (memory-mapped) NumPy array.
+        sample_rate:
+                    The sample rate (Hz) of the trigger channel.
+        mask:       Bit mask applied to the trigger values (e.g. 0xFF when
+                    the marker is in the lowest 8 bits of a status channel).
+        min_samples:
+                    Trigger values that last fewer samples are left out (e.g.
+                    intermediate values while the bits of the marker value
+                    change).
+        chunk_size: The number of samples read at once.
+
+    returns:
+        A dict with the sample, time_ms (from the start of the recording),
+        value and duration_ms of each marker onset, as NumPy arrays.
+    """
+
+    n_samples = len(trigger)
+    samples = [numpy.zeros(1, dtype=numpy.int64)]
+    values = []
+    for start in range(0, n_samples, chunk_size):
+        # One sample overlap with the previous chunk, to find the edge between the chunks
+        first = max(start - 1, 0)
+        block = numpy.asarray(trigger[first:start + chunk_size])
+        if mask is not None:
+            block = block & mask
+        if start == 0:
+            values.append(block[:1].astype(numpy.int64))
+        changes = numpy.flatnonzero(block[1:] != block[:-1]) + 1
+        samples.append(changes + first)
+        values.append(block[changes].astype(numpy.int64))
+    samples = numpy.concatenate(samples)
+    values = numpy.concatenate(values) if values else numpy.zeros(1, dtype=numpy.int64)
+    durations = numpy.diff(numpy.append(samples, n_samples))
+
+    # Leave out the values that are too short, and the changes to the same value that remain
+    if min_samples > 1:
+        keep = durations >= min_samples
+        samples, values = samples[keep], values[keep]
+        keep = numpy.ones(len(values), dtype=bool)
+        keep[1:] = values[1:] != values[:-1]
+        samples, values = samples[keep], values[keep]
+        durations = numpy.diff(numpy.append(samples, n_samples))
+
+    onsets = values != 0
+    return {'sample': samples[onsets],
+            'time_ms': samples[onsets] * 1000. / sample_rate,
+            'value': values[onsets],
+            'duration_ms': durations[onsets] * 1000. / sample_rate}
+
+
+def sequence_keys(values):
+
+    """
+    desc:
+        Returns a key per marker for the value of the marker and the values of
+        the next two markers, to pair markers with recorded markers in the same
+        sequence.
+    """
+
+    keys = numpy.full(len(values), -1, dtype=numpy.int64)
+    keys[:len(values) - 2] = (values[:-2] << 16) + (values[1:-1] << 8) + values[2:]
+    return keys
+
+
+def estimate_alignment(marker_time, marker_value, event_time, event_value, bin_ms,
+                       n_samples=2000, n_segments=20, max_pairs=4000000):
+
+    """
+    desc:
+        Estimates the alignment between the marker times and the recording:
+        event_time = slope * marker_time + offset. For a sample of the
+        recorded markers, the offsets to all markers with the same sequence
+        key are computed; the most common offset in each segment of the
+        recording is the offset of that segment. A robust (Theil-Sen) line
+        through the segment offsets gives the clock drift.
+
+    returns:
+        slope, offset (ms), or None when no alignment was found.
+    """
+
+    if len(marker_time) == 0 or len(event_time) == 0:
+        return None
+    marker_keys = sequence_keys(marker_value)
+    event_keys = sequence_keys(event_value)
+    order = numpy.argsort(marker_keys, kind='stable')
+    sorted_keys = marker_keys[order]
+
+    # Sample of recorded markers, fewer when many markers have the same key
+    sample = numpy.unique(numpy.linspace(0, len(event_time) - 1, min(n_samples, len(event_time))).astype(int))
+    sample = sample[event_keys[sample] >= 0]
+    low = numpy.searchsorted(sorted_keys, event_keys[sample], 'left')
+    high = numpy.searchsorted(sorted_keys, event_keys[sample], 'right')
+    counts = high - low
+    if counts.sum() > max_pairs:
+        keep = numpy.cumsum(counts) <= max_pairs
+        sample, low, counts = sample[keep], low[keep], counts[keep]
+    if counts.sum() == 0:
+        return None
+
+    # All pairs of sampled recorded markers and markers with the same key
+    pair_event = numpy.repeat(sample, counts)
+    pair_marker = order[numpy.repeat(low, counts) + numpy.arange(counts.sum())
+                        - numpy.repeat(numpy.cumsum(counts) - counts, counts)]
+    offsets = event_time[pair_event] - marker_time[pair_marker]
+    segments = numpy.minimum((pair_event * n_segments) // len(event_time), n_segments - 1)
+
+    # Most common offset (bin and its neighbours) per segment
+    segment_time = []
+    segment_offset = []
+    for segment in numpy.unique(segments):
+        segment_offsets = offsets[segments == segment]
+        bins, bin_counts = numpy.unique(numpy.round(segment_offsets / bin_ms).astype(numpy.int64),
+                                        return_counts=True)
+        window_counts = bin_counts.copy()
+        window_counts[1:] += bin_counts[:-1] * (numpy.diff(bins) == 1)
+        window_counts[:-1] += bin_counts[1:] * (numpy.diff(bins) == 1)
+        best = bins[numpy.argmax(window_counts)]
+        matched = numpy.abs(segment_offsets / bin_ms - best) <= 1.5
+        if matched.sum() < 3:
+            continue
+        segment_offset.append(numpy.median(segment_offsets[matched]))
+        segment_time.append(numpy.median(marker_time[pair_marker[segments == segment][matched]]))
+    if not segment_offset:
+        return None
+
+    segment_time = numpy.array(segment_time)
+    segment_offset = numpy.array(segment_offset)
+    drift = 0.
+    if len(segment_time) > 1:
+        i, j = numpy.triu_indices(len(segment_time), 1)
+        valid = segment_time[j] != segment_time[i]
+        if valid.any():
+            drift = numpy.median((segment_offset[j] - segment_offset[i])[valid]
+                                 / (segment_time[j] - segment_time[i])[valid])
+    offset = numpy.median(segment_offset - drift * segment_time)
+    return 1 + drift, offset
+
+
+def match_markers(predicted_time, event_time, tolerance_ms):
+
+    """
+    desc:
+        Pairs each marker (at its predicted time in the recording) with the
+        nearest recorded marker within tolerance_ms, each recorded marker is
+        paired with at most one marker (the nearest).
+
+    returns:
+        The index of the recorded marker of each marker (-1 when not paired).
+    """
+
+    if len(event_time) == 0:
+        return numpy.full(len(predicted_time), -1)
+    after = numpy.clip(numpy.searchsorted(event_time, predicted_time), 0, len(event_time) - 1)
+    before = numpy.clip(after - 1, 0, len(event_time) - 1)
+    use_before = numpy.abs(event_time[before] - predicted_time) < numpy.abs(event_time[after] - predicted_time)
+    nearest = numpy.where(use_before, before, after)
+    distance = numpy.abs(event_time[nearest] - predicted_time)
+    nearest[distance > tolerance_ms] = -1
+
+    # Recorded markers paired with more than one marker: keep the nearest marker
+    order = numpy.lexsort((distance, nearest))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = nearest[order][1:] != nearest[order][:-1]
+    duplicate = order[~first & (nearest[order] >= 0)]
+    nearest[duplicate] = -1
+    return nearest
+
+
+def verify_markers(markers, trigger, sample_rate, mask=None, min_samples=1, tolerance_ms=5.,
+                   as_dataframe=True):
+
+    """
+    desc:
+        Compares the markers sent by the markers plugin with the markers
+        recorded in a trigger channel. The marker times are aligned to the
+        recording (offset and clock drift), each marker is paired with the
+        recorded marker at the aligned time, and the markers are reported as
+        ok, wrong_value (recorded with another value), missing (not recorded)
+        or not_recorded (sent before the start or after the end of the
+        recording). Recorded markers that were not sent are extra markers.
+
+        The latency of a marker is the time of the recorded marker minus the
+        aligned marker time. Because the clocks are aligned on the markers
+        themselves, a constant latency is part of the offset; the latencies
+        show the variation of the latency (jitter) per marker.
+
+    arguments:
+        markers:    The markers: a marker file (marker table TSV or binary
+                    marker file), a marker table (DataFrame) or a dict with
+                    time_ms and value arrays.
+        trigger:    The trigger channel, a (memory-mapped) NumPy array.
+        sample_rate:
+                    The sample rate (Hz) of the trigger channel.
+        mask:       Bit mask applied to the trigger values.
+        min_samples:
+                    Trigger values that last fewer samples are left out.
+        tolerance_ms:
+                    The maximum difference (ms) between the aligned marker
+                    time and the recorded marker.
+        as_dataframe:
+                    Returns the marker tables as pandas DataFrames when True,
+                    otherwise as dicts of NumPy arrays.
+
+    returns:
+        A dict with the markers (one row per marker sent), the extra recorded
+        markers, and a summary (counts, offset, clock drift and latency).
+    """
+
+    if isinstance(markers, str):
+        markers = read_marker_table(markers)
+    markers = marker_arrays(markers)
+    sent = markers['value'] != 0
+    marker_time = markers['time_ms'][sent]
+    marker_value = markers['value'][sent]
+    if mask is not None:
+        marker_value = marker_value & mask
+
+    events = detect_trigger_edges(trigger, sample_rate, mask=mask, min_samples=min_samples)
+    event_time = events['time_ms']
+    event_value = events['value']
+    recording_ms = len(trigger) * 1000. / sample_rate
+
+    # Align: first estimate, then fit on the markers that were paired with the same value
+    alignment = estimate_alignment(marker_time, marker_value, event_time, event_value,
+                                   bin_ms=1000. / sample_rate + 1)
+    slope, offset = alignment if alignment is not None else (1., 0.)
+    paired = numpy.full(len(marker_time), -1)
+    if alignment is not None:
+        for iteration in range(3):
+            paired = match_markers(slope * marker_time + offset, event_time, tolerance_ms)
+            ok = paired >= 0
+            ok[ok] = event_value[paired[ok]] == marker_value[ok]
+            if ok.sum() < 2:
+                break
+            slope, offset = numpy.polyfit(marker_time[ok], event_time[paired[ok]], 1)
+
+    # Status per marker
+    predicted = slope * marker_time + offset
+    status = numpy.full(len(marker_time), STATUS_MISSING, dtype=object)
+    status[(predicted < 0) | (predicted > recording_ms)] = STATUS_NOT_RECORDED
+    found = paired >= 0
+    recorded_value = numpy.full(len(marker_time), -1, dtype=numpy.int64)
+    recorded_value[found] = event_value[paired[found]]
+    status[found & (recorded_value == marker_value)] = STATUS_OK
+    status[found & (recorded_value != marker_value)] = STATUS_WRONG_VALUE
+    sample = numpy.full(len(marker_time), -1, dtype=numpy.int64)
+    sample[found] = events['sample'][paired[found]]
+    latency_ms = numpy.full(len(marker_time), numpy.nan)
+    latency_ms[found] = event_time[paired[found]] - predicted[found]
+
+    extra = numpy.ones(len(event_time), dtype=bool)
+    extra[paired[found]] = False
+
+    marker_table = {'time_ms': marker_time, 'value': marker_value, 'status': status, 'sample': sample,
+                    'recorded_value': recorded_value, 'latency_ms': latency_ms}
+    extra_table = {name: column[extra] for name, column in events.items()}
+    ok_latency = latency_ms[status == STATUS_OK]
+    summary = {'markers': len(marker_time),
+               'recorded_markers': len(event_time),
+               'ok': int((status == STATUS_OK).sum()),
+               'wrong_value': int((status == STATUS_WRONG_VALUE).sum()),
+               'missing': int((status == STATUS_MISSING).sum()),
+               'not_recorded': int((status == STATUS_NOT_RECORDED).sum()),
+               'extra': int(extra.sum()),
+               'offset_ms': float(offset),
+               'drift_ppm': float((slope - 1) * 1e6),
+               'mean_latency_ms': float(ok_latency.mean()) if len(ok_latency) else numpy.nan,
+               'max_abs_latency_ms': float(numpy.abs(ok_latency).max()) if len(ok_latency) else numpy.nan,
+               'aligned': alignment is not None}
+
+    if as_dataframe:
+        import pandas
+        marker_table = pandas.DataFrame(marker_table)
+        extra_table = pandas.DataFrame(extra_table)
+    return {'markers': marker_table, 'extra': extra_table, 'summary': summary}
@@ -13,6 +13,15 @@ from libopensesame.metadata import major_version
 from libqtopensesame.misc.config import cfg
 import sys
 
+# Default maximum number of rows of a marker table shown in the tab, can be
+# changed with the markers_os3_max_table_rows config key
+MAX_TABLE_ROWS = 1000
+
+# Minimum time (s) between updates of the live Markers tab, and the number of
+# recent markers shown in it
+LIVE_REFRESH_INTERVAL = 2
+LIVE_MAX_ROWS = 50
+
 
 class markers_os3_extension(base_extension):
 
@@ -42,6 +51,86 @@ class markers_os3_extension(base_extension):
 		self.check_version()
 
 
+	def event_run_experiment(self, fullscreen):
+
+		"""
+		desc:
+			Resets the live Markers tab when an experiment starts.
+		"""
+
+		self._live_feeds = {}
+		self._live_rows = {}
+		self._live_refresh_time = 0
+
+	def event_set_workspace_globals(self, global_dict):
+
+		"""
+		desc:
+			Updates the live Markers tab with the marker feeds in the workspace,
+			which is sent by the experiment with every heartbeat.
+		"""
+
+		if not hasattr(self, '_live_feeds'):
+			self.event_run_experiment(False)
+
+		updated = False
+		for key, feed in global_dict.items():
+			if key.startswith('markers_live_') and isinstance(feed, dict):
+				updated |= self.update_live_feed(feed)
+
+		if updated and time.time() - self._live_refresh_time >= LIVE_REFRESH_INTERVAL:
+			self.refresh_live_tab()
+
+	def update_live_feed(self, feed):
+
+		"""
+		desc:
+			Appends the markers that were not seen yet to the rows of the tab.
+
+		returns:
+			True when there were new markers.
+		"""
+
+		tag = feed['tag']
+		previous = self._live_feeds.get(tag)
+		last_index = 0 if previous is None else previous['index']
+		if feed['index'] == last_index:
+			return False
+
+		rows = self._live_rows.setdefault(tag, [])
+		for index, time_ms, value, error in feed['rows']:
+			if index > last_index:
+				rows.append(u'| ' + str(index) + u' | ' + str(round(time_ms / 1000, 3)) + u' | ' + str(value) +
+							u' | ' + (u'error' if error else u'') + u' |')
+		del rows[:-LIVE_MAX_ROWS]
+		self._live_feeds[tag] = feed
+		return True
+
+	def refresh_live_tab(self):
+
+		"""
+		desc:
+			Shows the counts and the most recent markers of each device.
+		"""
+
+		md = u'Time: ' + str(time.ctime()) + u'\n\n'
+		for tag, feed in self._live_feeds.items():
+			md += u'#' + str(tag) + u'\n'
+			md += u'- Markers sent: ' + str(feed['index'] - feed['n_errors']) + u'\n'
+			md += u'- Marker errors: ' + str(feed['n_errors']) + u'\n\n'
+			md += u'##Markers per value:##\n| Value | Count |\n|:---|:---|\n'
+			for value, count in sorted(feed['counts'].items()):
+				md += u'| ' + str(value) + u' | ' + str(count) + u' |\n'
+			md += u'\n##Recent markers:##\n| Marker | Time (s) | Value | Error |\n|:---|:---|:---|:---|\n'
+			md += u'\n'.join(reversed(self._live_rows[tag])) + u'\n\n'
+
+		from libqtopensesame.widgets.webbrowser import webbrowser
+		if getattr(self, '_live_browser', None) is None:
+			self._live_browser = webbrowser(self.main_window)
+		self._live_browser.load_markdown(md)
+		self.tabwidget.add(self._live_browser, u'os-run', u'Markers', switch=False)
+		self._live_refresh_time = time.time()
+
 	def check_version(self):		
 
 		md = ''	
@@ -97,6 +186,7 @@ class markers_os3_extension(base_extension):
 			md += '- markers_os3_extension\n\n'
 			md += '- markers_os3_init\n\n'
 			md += '- markers_os3_send\n\n'
+			md += '- markers_os3_sequence\n\n'
 			md += 'It is advised to disable the plugins/extensions as listed above in Tools > Plug-in and extension manager.\n\n'
 			md += '''When using OpenSesame 4 and you want to send markers with a Leiden Univ marker device, 
 					please install the markers_os4 plugin: 
@@ -137,6 +227,10 @@ class markers_os3_extension(base_extension):
 
 			if hasattr(var, 'markers_tags'):
 
+				max_rows = MAX_TABLE_ROWS
+				if 'markers_os3_max_table_rows' in cfg:
+					max_rows = int(cfg['markers_os3_max_table_rows'])
+
 				# Get tag(s) of marker device(s)
 				marker_tags = var.markers_tags
 
@@ -159,6 +253,9 @@ class markers_os3_extension(base_extension):
 					summary_df = getattr(var, f"markers_summary_table_{tag}")
 					error_df = getattr(var, f"markers_error_table_{tag}")
 
+					# Full tables are saved in the marker file, when generated
+					marker_file = getattr(var, f"markers_file_{tag}", None)
+
 					# Add summary table to md
 					summary_df = summary_df.round(decimals=3)
 					md = add_table_to_md(md, summary_df, 'Summary table')
@@ -168,17 +265,35 @@ class markers_os3_extension(base_extension):
 
 					# Add marker table to md
 					marker_df = marker_df.round(decimals=3)
-					md = add_table_to_md(md, marker_df, 'Marker table')
+					md = add_table_to_md(md, marker_df, 'Marker table', max_rows=max_rows, full_table_path=marker_file)
 
 					if marker_df.empty:
 						md += u'No markers were sent, marker table empty\n\n'
 
 					# Add error table to md
-					md = add_table_to_md(md, error_df, 'Error table')
+					md = add_table_to_md(md, error_df, 'Error table', max_rows=max_rows, full_table_path=marker_file)
 
 					if error_df.empty:
 						md += u'No marker errors occurred, error table empty\n\n'
 
+					# Add write latency summary to md
+					latency_summary_df = getattr(var, f"markers_latency_summary_{tag}", None)
+					if latency_summary_df is not None:
+						latency_summary_df = latency_summary_df.round(decimals=3)
+						md = add_table_to_md(md, latency_summary_df, 'Write latency summary')
+
+					# Add clock sync table to md, when the OpenSesame clock was sampled during the experiment
+					clock_sync_df = getattr(var, f"markers_clock_sync_table_{tag}", None)
+					if clock_sync_df is not None:
+						clock_sync_df = clock_sync_df.round(decimals=3)
+						md = add_table_to_md(md, clock_sync_df, 'Clock sync table', max_rows=max_rows)
+
+					# Add deferral table to md, when marker values were deferred or coalesced in queued write mode
+					deferral_df = getattr(var, f"markers_deferral_table_{tag}", None)
+					if deferral_df is not None:
+						deferral_df = deferral_df.round(decimals=3)
+						md = add_table_to_md(md, deferral_df, 'Deferred markers table', max_rows=max_rows)
+
 				# Open the tab
 				self.tabwidget.open_markdown(md, u'os-finished-success', u'Marker tables')
 
@@ -190,15 +305,20 @@ class markers_os3_extension(base_extension):
 			self.tabwidget.open_markdown(md, u'os-finished-user-interrupt', u'Marker tables')
 			
 
-def add_table_to_md(md, df, table_title):
+def add_table_to_md(md, df, table_title, max_rows=None, full_table_path=None):
+
+	"""
+	desc:
+		Adds a DataFrame as markdown table to md. The values are formatted per
+		column, so that large tables can be rendered quickly. When max_rows is
+		given, only the first max_rows rows are added.
+	"""
 
 	# Table title
 	md += u'##' + table_title + u':##' + u'\n'
 
-	ncols = len(df.columns)
-
 	# Column headers
-	md += u'| '
+	headers = []
 	for column in df:
 
 		if "_s" in column:
@@ -209,23 +329,29 @@ def add_table_to_md(md, df, table_title):
 			column = column.replace("_", " ")
 		column = column.capitalize()
 
-		md += column + u' | '
-	md += u'\n'
-
-	# Header separator
-	md += u'|'
-	for col in range(ncols):
-		md += u':---|'
-	md += u'\n'
-
-	# Values
-	md += u'| '
-	for index, row in df.iterrows():
-		for column in df:
-			cur_value = row[column]
-			if isinstance(cur_value, float):
-				cur_value = round(cur_value, 3)
-			md += str(cur_value) + u' | '
+		headers.append(column)
+
+	lines = [u'| ' + u' | '.join(headers) + u' | ', u'|' + u':---|' * len(headers)]
+
+	# Values, formatted per column
+	n_rows = len(df)
+	if max_rows is not None and n_rows > max_rows:
+		df = df.iloc[:max_rows]
+	columns = []
+	for column in df:
+		values = df[column]
+		if values.dtype.kind == 'f':
+			values = values.round(3)
+		columns.append(values.astype(str).tolist())
+	for row in zip(*columns):
+		lines.append(u'| ' + u' | '.join(row) + u' | ')
+
+	md += u'\n'.join(lines) + u'\n'
+
+	if len(df) < n_rows:
+		md += u'\nShowing the first ' + str(len(df)) + u' of ' + str(n_rows) + u' rows.'
+		if full_table_path is not None:
+			md += u' The full table can be found in: ' + str(full_table_path)
 		md += u'\n'
 
 	md += u'\n\n'
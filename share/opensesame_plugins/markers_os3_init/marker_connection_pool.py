@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+
+"""
+Process-level pool of marker device connections, used by markers_os3_init
+when *Keep connection open* is checked. The OpenSesame plugin module itself
+is loaded again for every item, this module is loaded once per process (see
+connection_pool in markers_os3_init), so the connections stay open between
+consecutive runs of an experiment (with the inprocess runner).
+"""
+
+import threading
+import atexit
+
+_pool = {}
+_lock = threading.Lock()
+
+
+class PooledConnection:
+    """
+    A marker manager that is kept open between experiment runs. The marker
+    manager gets the time from time_ms, which calls the clock of the current
+    run. The marker tables of a run come from the pulse scheduler of that
+    run, which is new for every run.
+    """
+
+    def __init__(self, key, marker_manager, device, com_port, time_function_ms):
+
+        self.key = key
+        self.marker_manager = marker_manager
+        self.device = device
+        self.com_port = com_port
+        self.time_function_ms = time_function_ms
+        self.runs = 0
+
+    def time_ms(self):
+        return self.time_function_ms()
+
+    def is_stale(self):
+
+        """
+        desc:
+            Returns True when the serial port of the connection is gone (e.g.
+            the device was unplugged), without writing to the device.
+        """
+
+        if self.com_port == 'FAKE':
+            return False
+        try:
+            import serial.tools.list_ports
+            return self.com_port not in [port.device for port in serial.tools.list_ports.comports()]
+        except Exception:
+            return True
+
+    def start_run(self, time_function_ms):
+
+        """
+        desc:
+            Prepares the connection for a new run: the time stamps use the
+            clock of the new run.
+        """
+
+        self.time_function_ms = time_function_ms
+        self.runs += 1
+
+    def close(self):
+
+        try:
+            self.marker_manager.close()
+        except Exception:
+            pass
+
+
+def pool_key(device_tag, device_type, device_address, serial_no, dummy_mode, crash_on_marker_errors):
+
+    """
+    desc:
+        Returns the key of a connection: the device serial number, or the
+        device tag, type and address when the serial number is not specified,
+        and the crash on marker errors setting of the marker manager.
+    """
+
+    crash = bool(crash_on_marker_errors)
+    if dummy_mode:
+        return ('FAKE', str(device_tag), crash)
+    if serial_no not in (u'ANY', u''):
+        return ('serial', str(serial_no), crash)
+    return ('device', str(device_tag), str(device_type), str(device_address), crash)
+
+
+def acquire(key):
+
+    """
+    desc:
+        Returns the open connection for key and removes it from the pool, or
+        None when there is no connection or when it is stale.
+    """
+
+    with _lock:
+        connection = _pool.pop(key, None)
+    if connection is not None and connection.is_stale():
+        print(f"Marker device connection on {connection.com_port} is no longer available, reconnecting.")
+        connection.close()
+        return None
+    return connection
+
+
+def release(connection):
+
+    """
+    desc:
+        Returns a connection to the pool, to be used by the next run.
+    """
+
+    with _lock:
+        previous = _pool.pop(connection.key, None)
+        _pool[connection.key] = connection
+    if previous is not None and previous is not connection:
+        previous.close()
+
+
+def close_all():
+
+    """
+    desc:
+        Closes all connections in the pool.
+    """
+
+    with _lock:
+        connections = list(_pool.values())
+        _pool.clear()
+    for connection in connections:
+        connection.close()
+
+
+atexit.register(close_all)
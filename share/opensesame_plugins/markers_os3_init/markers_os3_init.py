@@ -8,13 +8,1381 @@ from libopensesame.py3compat import *
 from libopensesame.item import item
 from libqtopensesame.items.qtautoplugin import qtautoplugin
 from libopensesame.exceptions import osexception
-import serial
 import sys
 import re
 import os
-import pandas
+import threading
+import time
+import json
+import collections
+import math
+from concurrent.futures import Future
+
+# Device tag: letters, numbers, underscores and dashes, starting with a letter
+TAG_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_-]*$")
+# Device address: COM port
+ADDR_PATTERN = re.compile(r"^COM\d{1,3}")
+# Columns of the marker summary (one row per non-zero marker value)
+SUMMARY_COLUMNS = ['value', 'occurrence', 'min_duration_ms', 'mean_duration_ms', 'max_duration_ms',
+                   'min_interval_ms', 'mean_interval_ms', 'max_interval_ms', 'write_errors', 'error_rate']
+# Version of the marker file of Generate marker file (info row, summary, marker
+# and error table). Version 1 was written by save_marker_table of python_markers.
+MARKER_FILE_FORMAT = 2
+
+
+def marker_management():
 
-from python_markers import marker_management as mark
+    """
+    desc:
+        Imports the marker_management module of python_markers. The import is
+        deferred until a marker device is used, because it imports pandas,
+        which slows down loading the plugin.
+    """
+
+    from python_markers import marker_management as mark
+    return mark
+
+
+def connection_pool():
+
+    """
+    desc:
+        Returns the marker_connection_pool module next to this file. It is
+        loaded once per process and kept in sys.modules, because this module
+        is loaded again for every item.
+    """
+
+    module = sys.modules.get('markers_os3_connection_pool')
+    if module is None:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(
+            'markers_os3_connection_pool',
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'marker_connection_pool.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module = sys.modules.setdefault('markers_os3_connection_pool', module)
+    return module
+
+
+def save_marker_file(path, info, tables):
+
+    """
+    desc:
+        Saves the marker file of Generate marker file: the info row (info,
+        after the format version) and the summary, marker and error table,
+        separated by empty lines.
+    """
+
+    import pandas
+
+    with open(path, 'w', newline='') as f:
+        pandas.DataFrame([{'format_version': MARKER_FILE_FORMAT, **info}]).to_csv(f, sep='\t', index=False)
+        for table in tables:
+            f.write('\n')
+            table.to_csv(f, sep='\t', index=False)
+
+
+def device_cache_path():
+
+    """
+    desc:
+        Returns the path of the file in which resolved marker devices are cached.
+    """
+
+    base = os.environ.get('APPDATA', os.path.expanduser('~'))
+    return os.path.join(base, 'opensesame_markers', 'device_cache.json')
+
+
+def device_cache_key(device_type, serial_no):
+    return f"{device_type or 'ANY'}|{serial_no or 'ANY'}"
+
+
+def read_device_cache():
+
+    """
+    desc:
+        Reads the device cache, returns an empty dict when there is no (valid) cache.
+    """
+
+    try:
+        with open(device_cache_path(), 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_device_cache(cache):
+
+    try:
+        os.makedirs(os.path.dirname(device_cache_path()), exist_ok=True)
+        with open(device_cache_path(), 'w') as f:
+            json.dump(cache, f, indent=4, default=str)
+    except OSError:
+        print("WARNING: Could not write marker device cache.")
+
+
+def clear_device_cache(cache_key=None):
+
+    """
+    desc:
+        Removes the cached marker device of cache_key (see device_cache_key),
+        or all cached marker devices when cache_key is None.
+    """
+
+    if cache_key is None:
+        try:
+            os.remove(device_cache_path())
+        except OSError:
+            pass
+        return
+    cache = read_device_cache()
+    if cache.pop(cache_key, None) is not None:
+        write_device_cache(cache)
+
+
+class DeviceDiscovery:
+    """
+    Probes the serial ports concurrently for marker devices, at most
+    max_workers ports at a time. One discovery is shared by all
+    markers_os3_init items of an experiment that search for ANY device, so
+    the ports are only scanned once.
+
+    A port that does not answer within port_timeout after its probe started
+    is skipped. The probe threads are daemon threads, so a probe that hangs on
+    a port does not block the exit of Python (unlike the threads of a
+    ThreadPoolExecutor, which are joined at exit).
+    """
+
+    # Time (s) to wait for a port to answer
+    port_timeout = 2
+    # Maximum number of ports that are probed at the same time
+    max_workers = 8
+
+    def __init__(self):
+
+        from serial.tools import list_ports
+
+        self.ports = [port.device for port in list_ports.comports()]
+        self._cond = threading.Condition()
+        # Device info of the ports that answered, in order of answering, and
+        # the ports of which the probe is finished
+        self._found = []
+        self._finished = set()
+        self._pending = collections.deque(self.ports)
+        # Every port gets port_timeout, in rounds of max_workers ports
+        n_rounds = -(-len(self.ports) // self.max_workers)
+        self._deadline = time.perf_counter() + n_rounds * self.port_timeout
+        find_device = marker_management().find_device
+        for i in range(min(self.max_workers, len(self.ports))):
+            thread = threading.Thread(target=self._probe_ports, args=(find_device,),
+                                      name=f'markers_device_discovery_{i}')
+            thread.daemon = True
+            thread.start()
+
+    def _probe_ports(self, find_device):
+
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return
+                port = self._pending.popleft()
+            start = time.perf_counter()
+            device_info = None
+            try:
+                device_info = find_device(device_type='', serial_no='', com_port=port, fallback_to_fake=False)
+            except Exception:
+                pass
+            # An answer after the timeout is ignored, the port may already be skipped
+            with self._cond:
+                if device_info is not None and time.perf_counter() - start < self.port_timeout:
+                    self._found.append((port, device_info))
+                self._finished.add(port)
+                self._cond.notify_all()
+
+    def find(self, exclude_ports=()):
+
+        """
+        desc:
+            Returns the device info of the first device that answers on a port
+            that is not in exclude_ports.
+        """
+
+        with self._cond:
+            while True:
+                for port, device_info in self._found:
+                    if port not in exclude_ports:
+                        return device_info
+                remaining = self._deadline - time.perf_counter()
+                if remaining <= 0 or len(self._finished) == len(self.ports):
+                    break
+                self._cond.wait(remaining)
+        raise Exception(f"No marker device found on ports: {', '.join(self.ports) or 'no ports available'}")
+
+
+class MarkerStore:
+    """
+    Compact column store for the markers written to a device. Markers are
+    stored in preallocated NumPy chunks that are added when needed. When
+    max_chunks is given, the store is a ring buffer: older chunks are appended
+    to spill_path (raw records, see load_spilled) and removed from memory.
+    """
+
+    chunk_size = 4096
+    fields = [('time_ms', 'f8'), ('value', 'i2'), ('write_start_ns', 'i8'), ('write_end_ns', 'i8'),
+              ('error', 'i1')]
+
+    def __init__(self, max_chunks=None, spill_path=None):
+
+        import numpy
+
+        self.dtype = numpy.dtype(self.fields)
+        self.max_chunks = max_chunks
+        self.spill_path = spill_path
+        self.n_spilled = 0
+        self._chunks = [numpy.empty(self.chunk_size, dtype=self.dtype)]
+        self._n_last = 0
+        # Start with an empty spill file, not with the markers of an earlier session
+        if spill_path is not None:
+            open(spill_path, 'wb').close()
+
+    def __len__(self):
+        return self.n_spilled + (len(self._chunks) - 1) * self.chunk_size + self._n_last
+
+    def append(self, time_ms, value, write_start_ns, write_end_ns, error=0):
+
+        """
+        desc:
+            Adds a marker, error is 1 when the marker could not be written.
+            A value that is not a marker value (only possible for errors) is
+            stored as -1.
+        """
+
+        if not 0 <= value <= 255:
+            value = -1
+        if self._n_last == self.chunk_size:
+            self._add_chunk()
+        self._chunks[-1][self._n_last] = (time_ms, value, write_start_ns, write_end_ns, error)
+        self._n_last += 1
+
+    def _add_chunk(self):
+
+        import numpy
+
+        if self.max_chunks is not None and len(self._chunks) >= self.max_chunks:
+            oldest = self._chunks.pop(0)
+            if self.spill_path is not None:
+                with open(self.spill_path, 'ab') as f:
+                    f.write(oldest.tobytes())
+            self.n_spilled += len(oldest)
+        self._chunks.append(numpy.empty(self.chunk_size, dtype=self.dtype))
+        self._n_last = 0
+
+    def load_spilled(self):
+
+        """
+        desc:
+            Returns the spilled markers, memory-mapped from spill_path.
+        """
+
+        import numpy
+
+        if self.spill_path is None or not os.path.exists(self.spill_path) or self.n_spilled == 0:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.memmap(self.spill_path, dtype=self.dtype, mode='r')
+
+    def last(self):
+
+        """
+        desc:
+            Returns the last marker, or None when there are no markers.
+        """
+
+        if self._n_last == 0:
+            return self._chunks[-2][-1] if len(self._chunks) > 1 else None
+        return self._chunks[-1][self._n_last - 1]
+
+    def records(self, include_spilled=False):
+
+        """
+        desc:
+            Returns the markers as one structured array.
+        """
+
+        import numpy
+
+        parts = self._chunks[:-1] + [self._chunks[-1][:self._n_last]]
+        if include_spilled:
+            parts.insert(0, self.load_spilled())
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts)
+
+    def save(self, path_base, file_format='feather'):
+
+        """
+        desc:
+            Saves all markers (including the spilled markers) as a typed
+            columnar file: Feather (uncompressed, so it can be memory-mapped),
+            Parquet, or a NumPy .npy file. Feather and Parquet need pyarrow,
+            without it the .npy file is written.
+
+        returns:
+            The path of the file.
+        """
+
+        import numpy
+
+        records = self.records(include_spilled=True)
+        if file_format in ('feather', 'parquet'):
+            try:
+                import pyarrow
+                import pandas
+            except ImportError:
+                print(f"WARNING: pyarrow is not installed, markers are saved as .npy instead of .{file_format}")
+                file_format = 'npy'
+
+        path = path_base + '.' + file_format
+        if file_format == 'feather':
+            pandas.DataFrame(records).to_feather(path, compression='uncompressed')
+        elif file_format == 'parquet':
+            pandas.DataFrame(records).to_parquet(path, index=False)
+        else:
+            numpy.save(path, records)
+        return path
+
+
+class MarkerSummary:
+    """
+    Running summary per marker value, updated for every marker, so that the
+    summary at the end of the experiment does not depend on the number of
+    markers. Per non-zero marker value: the occurrence, the duration (time
+    until the next marker), the interval (time since the previous non-zero
+    marker) and the number of markers that could not be written.
+    """
+
+    def __init__(self):
+
+        # value: [occurrence, write errors, duration stats, interval stats],
+        # stats: [count, sum, min, max]
+        self._stats = {}
+        self._last_marker = None
+        self._last_onset_ms = None
+
+    def _value_stats(self, value):
+
+        stats = self._stats.get(value)
+        if stats is None:
+            stats = self._stats[value] = [0, 0, [0, 0., math.inf, -math.inf], [0, 0., math.inf, -math.inf]]
+        return stats
+
+    @staticmethod
+    def _add(stats, x):
+
+        stats[0] += 1
+        stats[1] += x
+        if x < stats[2]:
+            stats[2] = x
+        if x > stats[3]:
+            stats[3] = x
+
+    def add(self, time_ms, value, error=False):
+
+        """
+        desc:
+            Adds a marker (or a marker that could not be written).
+        """
+
+        if error:
+            if value != 0:
+                self._value_stats(value)[1] += 1
+            return
+
+        # The duration of the previous marker is known now
+        if self._last_marker is not None:
+            last_time_ms, last_value = self._last_marker
+            if last_value != 0:
+                self._add(self._stats[last_value][2], time_ms - last_time_ms)
+        self._last_marker = (time_ms, value)
+
+        if value != 0:
+            stats = self._value_stats(value)
+            stats[0] += 1
+            if self._last_onset_ms is not None:
+                self._add(stats[3], time_ms - self._last_onset_ms)
+            self._last_onset_ms = time_ms
+
+    def rows(self):
+
+        """
+        desc:
+            Returns a list with one dict per (non-zero) marker value, with the
+            keys of SUMMARY_COLUMNS.
+        """
+
+        rows = []
+        for value, (occurrence, write_errors, durations, intervals) in sorted(self._stats.items()):
+            row = {'value': value, 'occurrence': occurrence}
+            for name, stats in (('duration', durations), ('interval', intervals)):
+                count, total, minimum, maximum = stats
+                row[f'min_{name}_ms'] = minimum if count else math.nan
+                row[f'mean_{name}_ms'] = total / count if count else math.nan
+                row[f'max_{name}_ms'] = maximum if count else math.nan
+            row['write_errors'] = write_errors
+            row['error_rate'] = write_errors / (occurrence + write_errors)
+            rows.append(row)
+        return rows
+
+
+class LiveFeed:
+    """
+    Recent markers and running counts of a marker device, for the live
+    Markers tab of the extension. The feed is put in the Python workspace,
+    which OpenSesame sends to the GUI with every heartbeat. It is pickled as a
+    plain dict, so the GUI does not need this class.
+    """
+
+    max_rows = 500
+
+    def __init__(self, tag):
+
+        self.tag = tag
+        self._lock = threading.Lock()
+        self._rows = collections.deque(maxlen=self.max_rows)
+        self._index = 0
+        self._counts = {}
+        self._n_errors = 0
+
+    def add(self, time_ms, value, error=False):
+
+        """
+        desc:
+            Adds a marker (or a marker that could not be written).
+        """
+
+        with self._lock:
+            self._index += 1
+            self._rows.append((self._index, time_ms, value, error))
+            if error:
+                self._n_errors += 1
+            else:
+                self._counts[value] = self._counts.get(value, 0) + 1
+
+    def snapshot(self):
+
+        with self._lock:
+            return {'tag': self.tag,
+                    'index': self._index,
+                    'n_errors': self._n_errors,
+                    'counts': dict(self._counts),
+                    'rows': list(self._rows)}
+
+    def __reduce__(self):
+        return dict, (self.snapshot(),)
+
+
+class ClockSync(threading.Thread):
+    """
+    Marker time stamps from time.perf_counter_ns, in milliseconds on the
+    OpenSesame clock. The OpenSesame clock is sampled together with
+    perf_counter_ns, and a linear fit of the samples (offset and drift)
+    maps perf_counter_ns to the OpenSesame clock. When the thread is not
+    started, only the sample taken on construction is used (offset only).
+    """
+
+    # Time (s) between samples, and the number of most recent samples used for the fit
+    sample_interval = 1
+    max_fit_samples = 600
+    # Minimum time (s) between the first and last sample to fit the drift,
+    # before that only the offset is fitted
+    min_drift_span = 30
+
+    def __init__(self, opensesame_time_ms):
+
+        threading.Thread.__init__(self, name='markers_clock_sync')
+        self.daemon = True
+        self.opensesame_time_ms = opensesame_time_ms
+        self.samples = []
+        self._origin_ns = time.perf_counter_ns()
+        self._fit = (1e-6, 0.)
+        self._stop_event = threading.Event()
+        self.sample()
+
+    def time_ms(self):
+
+        """
+        desc:
+            Returns the current time (ms) on the OpenSesame clock.
+        """
+
+        slope, offset = self._fit
+        return (time.perf_counter_ns() - self._origin_ns) * slope + offset
+
+    def sample(self):
+
+        """
+        desc:
+            Samples both clocks and updates the fit. The OpenSesame clock is
+            read between two perf_counter_ns reads, the midpoint is used.
+        """
+
+        before_ns = time.perf_counter_ns()
+        opensesame_ms = self.opensesame_time_ms()
+        after_ns = time.perf_counter_ns()
+        self.samples.append(((before_ns + after_ns) / 2 - self._origin_ns, opensesame_ms, after_ns - before_ns))
+        self._fit = self.fit(self.samples[-self.max_fit_samples:])
+
+    @staticmethod
+    def fit(samples):
+
+        """
+        desc:
+            Least squares fit of the OpenSesame time (ms) on the perf_counter
+            time (ns), returns the slope and offset. When the samples span
+            less than min_drift_span, only the offset is fitted.
+        """
+
+        n = len(samples)
+        mean_ns = sum(sample[0] for sample in samples) / n
+        mean_ms = sum(sample[1] for sample in samples) / n
+        if samples[-1][0] - samples[0][0] < ClockSync.min_drift_span * 1e9:
+            return 1e-6, mean_ms - mean_ns * 1e-6
+        var_ns = sum((sample[0] - mean_ns) ** 2 for sample in samples)
+        slope = sum((sample[0] - mean_ns) * (sample[1] - mean_ms) for sample in samples) / var_ns
+        return slope, mean_ms - slope * mean_ns
+
+    def run(self):
+
+        while not self._stop_event.wait(self.sample_interval):
+            self.sample()
+
+    def stop(self):
+
+        if self.is_alive():
+            self._stop_event.set()
+            self.join()
+            self.sample()
+
+    def table(self):
+
+        """
+        desc:
+            Returns the samples with the time on both clocks and the residual
+            of the final fit, as rows of: perf_counter_ms, opensesame_ms,
+            fitted_ms, residual_ms, sample_duration_us.
+        """
+
+        slope, offset = self._fit
+        rows = []
+        for perf_ns, opensesame_ms, duration_ns in self.samples:
+            fitted_ms = perf_ns * slope + offset
+            rows.append((perf_ns / 1e6, opensesame_ms, fitted_ms, opensesame_ms - fitted_ms, duration_ns / 1000))
+        return rows
+
+    def summary(self):
+
+        """
+        desc:
+            Returns the drift (ppm) and the maximum absolute residual (ms) of
+            the final fit.
+        """
+
+        slope, offset = self._fit
+        return {'clock_drift_ppm': (slope * 1e6 - 1) * 1e6,
+                'clock_max_residual_ms': max(abs(row[3]) for row in self.table())}
+
+
+class MarkerLogWriter(threading.Thread):
+    """
+    Append-only marker log: marker and error rows are queued by the thread
+    that sets the marker value and written to a TSV file by a background
+    thread, so that the log survives a crash without slowing down the trials.
+    """
+
+    columns = ['type', 'time_ms', 'value', 'message', 'write_latency_us']
+
+    def __init__(self, path, flush_interval=0.5):
+
+        threading.Thread.__init__(self, name='markers_log_writer')
+        self.daemon = True
+        self.path = path
+        self.flush_interval = flush_interval
+        self._rows = collections.deque()
+        self._stop_event = threading.Event()
+        self._file = open(path, 'w', newline='')
+        self._file.write('\t'.join(self.columns) + '\n')
+        self._file.flush()
+
+    def log_marker(self, time_ms, value, write_latency_us=''):
+
+        """
+        desc:
+            Queues a marker row.
+        """
+
+        self._rows.append(('marker', time_ms, value, '', write_latency_us))
+
+    def log_error(self, time_ms, value, message):
+
+        """
+        desc:
+            Queues an error row.
+        """
+
+        self._rows.append(('error', time_ms, value, message, ''))
+
+    def log_deferral(self, time_ms, value, delay_ms, action):
+
+        """
+        desc:
+            Queues a row for a marker value that was deferred (by delay_ms) or
+            coalesced (skipped) in queued write mode.
+        """
+
+        self._rows.append((action, time_ms, value, f'delay_ms={delay_ms:.3f}', ''))
+
+    def log_broadcast(self, time_ms, value, skew_ms):
+
+        """
+        desc:
+            Queues a row with the skew of a marker sent to multiple devices.
+        """
+
+        self._rows.append(('broadcast', time_ms, value, f'skew_ms={skew_ms:.3f}', ''))
+
+    def flush(self):
+
+        lines = []
+        while self._rows:
+            lines.append('\t'.join(str(field) for field in self._rows.popleft()) + '\n')
+        if lines:
+            self._file.write(''.join(lines))
+            self._file.flush()
+
+    def run(self):
+
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+
+        """
+        desc:
+            Writes the remaining rows and closes the file.
+        """
+
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        self._file.close()
+
+
+class SwitchInterval:
+    """
+    Lowers the thread switch interval of the interpreter (sys.setswitchinterval)
+    shortly before the deadline of a pulse scheduler. A scheduler thread that
+    wakes up for a deadline has to get the GIL from the main thread first;
+    with the default interval (5 ms), a main thread that runs Python code
+    (e.g. polling for a response) delays the reset by up to 5 ms. One switch
+    interval is shared by all pulse schedulers of an experiment, the original
+    interval is restored when none of them is close to a deadline.
+    """
+
+    # Switch interval (s) while a deadline is pending
+    interval = 0.0001
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._users = 0
+        self._original = None
+
+    def lower(self):
+
+        with self._lock:
+            self._users += 1
+            if self._users == 1:
+                self._original = sys.getswitchinterval()
+                sys.setswitchinterval(min(self.interval, self._original))
+
+    def original(self):
+
+        """
+        desc:
+            Returns the switch interval (s) of the interpreter when it is not
+            lowered.
+        """
+
+        with self._lock:
+            return self._original if self._users else sys.getswitchinterval()
+
+    def restore(self):
+
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                sys.setswitchinterval(self._original)
+
+
+class PulseScheduler(threading.Thread):
+    """
+    Background thread that resets the marker value of one marker device to 0
+    at a requested deadline, so that markers_os3_send items in pulse mode do
+    not have to block for the duration of the marker. It also runs scheduled
+    sequences of marker values (e.g. the flash on initialization), new marker
+    values wait until a running sequence is finished.
+
+    With min_duration (s), writes are queued: a marker value that comes less
+    than min_duration after the previous one is written later by the thread,
+    and a value that is the same as the previous one is skipped (coalesced).
+    The time between writes is measured from the actual end of the previous
+    write, and is at least the minimum marker duration of the marker manager
+    (plus a margin), so queued writes never cause marker duration errors.
+
+    From lower_window before a deadline until the write, the thread switch
+    interval is lowered (see SwitchInterval), so the thread gets the GIL in
+    time for the deadline while the main thread keeps the original interval
+    the rest of the time.
+    """
+
+    # Time (s) before the deadline at which waiting changes to busy waiting,
+    # longer on Windows, where waits overshoot by up to the timer resolution
+    spin_time = 0.002 if sys.platform == 'win32' else 0.0005
+    # Minimum duration (ms) of a marker, shorter markers are marker errors
+    min_marker_duration = 10
+    # Margin (s) on the minimum marker duration in queued write mode
+    queue_margin = 0.0005
+    # Margin (s) on the time before a deadline at which the switch interval is lowered
+    lower_margin = 0.001
+
+    def __init__(self, marker_manager, time_function_ms, marker_log=None, marker_store=None, live_feed=None,
+                 min_duration=None, switch_interval=None, crash_on_marker_errors=False):
+
+        threading.Thread.__init__(self, name='markers_pulse_scheduler')
+        self.daemon = True
+        self.marker_manager = marker_manager
+        self.time_function_ms = time_function_ms
+        self.marker_log = marker_log
+        self.live_feed = live_feed
+        self.summary = MarkerSummary()
+        self.broadcast_skews = []
+        self.min_duration = min_duration
+        self.crash_on_marker_errors = crash_on_marker_errors
+        self.deferrals = []
+        # Marker errors as (time_ms, value, message), also the errors that the
+        # marker manager only records (Crash on marker errors unchecked)
+        self.errors = []
+        self.switch_interval = switch_interval if switch_interval is not None else SwitchInterval()
+        self._lowered = False
+
+        # Time and perf_counter_ns before and after each write to the marker device
+        self.marker_store = marker_store if marker_store is not None else MarkerStore()
+        self._cond = threading.Condition()
+        # Pending (deadline, value, future) edges, value None only holds the
+        # sequence. The future (queued write mode, None otherwise) resolves
+        # with the time of the marker when it is written.
+        self._edges = collections.deque()
+        self._sequence = False
+        self._last_write = -math.inf
+        self._last_value = None
+        self._last_time_ms = None
+        self._pulse_id = 0
+        self._stopped = False
+        self._error = None
+
+    def set_value(self, value, time_ms=None):
+
+        """
+        desc:
+            Sets the marker value, cancelling a pending reset. The time of the
+            marker is time_ms when given (e.g. the time of a canvas flip).
+
+        returns:
+            The time (ms) of the marker, or in queued write mode a Future
+            with the time of the marker when it is written later (see
+            _queue).
+        """
+
+        with self._cond:
+            self.raise_error()
+            self._wait_for_sequence()
+            if self.min_duration is not None:
+                time_ms = self._queue(value, time_ms)
+            else:
+                self._edges.clear()
+                self._pulse_id += 1
+                time_ms = self._write(value, time_ms)
+            self._cond.notify_all()
+        return time_ms
+
+    def pulse(self, value, duration, time_ms=None):
+
+        """
+        desc:
+            Sets the marker value and schedules a reset to 0 after duration (ms).
+            The time of the marker is time_ms when given.
+
+        returns:
+            The time (ms) of the marker, or a Future (as set_value).
+        """
+
+        with self._cond:
+            self.raise_error()
+            self._wait_for_sequence()
+            if self.min_duration is not None:
+                time_ms = self._queue(value, time_ms)
+                start = self._edges[-1][0] if self._edges else self._last_write
+                self._edges.append((start + max(duration / 1000, self.min_gap()), 0, Future()))
+            else:
+                self._pulse_id += 1
+                time_ms = self._write(value, time_ms)
+                self._edges = collections.deque([(time.perf_counter() + duration / 1000, 0, None)])
+            self._lower_switch_interval(self._edges[0][0])
+            self._cond.notify_all()
+        return time_ms
+
+    def _queue(self, value, time_ms=None):
+
+        """
+        desc:
+            Writes the marker value, or queues it when it comes less than
+            min_duration after the previous marker value, or skips it when it
+            is the same as the previous marker value. Called with the lock held.
+
+        returns:
+            The time (ms) of the marker when it is written right away, or a
+            Future that resolves with the time of the marker when it is
+            written by the thread (or is cancelled when the queue is cleared
+            by an error). A skipped value returns the time, or the Future, of
+            the previous marker with the same value.
+        """
+
+        last_edge = self._edges[-1] if self._edges else None
+        last_value = last_edge[1] if last_edge is not None else self._last_value
+        if value == last_value:
+            self._log_deferral(value, 0., 'coalesced')
+            return last_edge[2] if last_edge is not None else self._last_time_ms
+        now = time.perf_counter()
+        earliest = (self._edges[-1][0] if self._edges else self._last_write) + self.min_gap()
+        if not self._edges and now >= earliest:
+            return self._write(value, time_ms)
+        deadline = max(now, earliest)
+        future = Future()
+        self._edges.append((deadline, value, future))
+        self._lower_switch_interval(self._edges[0][0])
+        self._log_deferral(value, (deadline - now) * 1000, 'deferred')
+        return future
+
+    def min_gap(self):
+
+        """
+        desc:
+            Returns the minimum time (s) between two writes in queued write
+            mode.
+        """
+
+        return max(self.min_duration, self.min_marker_duration / 1000) + self.queue_margin
+
+    def _log_deferral(self, value, delay_ms, action):
+
+        time_ms = self.time_function_ms()
+        self.deferrals.append((time_ms, value, delay_ms, action))
+        if self.marker_log is not None:
+            self.marker_log.log_deferral(time_ms, value, delay_ms, action)
+
+    def schedule(self, edges):
+
+        """
+        desc:
+            Schedules a sequence of marker values and returns immediately.
+            Marker values set while the sequence runs wait for it to finish.
+            As with pulse, a first marker value at time 0 is written right
+            away (except in queued write mode), the scheduler thread writes
+            the rest.
+
+        arguments:
+            edges:      List of (time, value) tuples, with the time (ms)
+                        relative to now. A value of None writes nothing, but
+                        holds the sequence until that time.
+        """
+
+        with self._cond:
+            self.raise_error()
+            self._wait_for_sequence()
+            start = time.perf_counter()
+            self._pulse_id += 1
+            self._clear_edges()
+            self._edges.extend((start + edge_time / 1000, value, None) for edge_time, value in edges)
+            if self.min_duration is None and self._edges and self._edges[0][0] == start:
+                value = self._edges.popleft()[1]
+                if value is not None:
+                    self._write(value)
+            self._sequence = bool(self._edges)
+            if self._edges:
+                self._lower_switch_interval(self._edges[0][0])
+            self._cond.notify_all()
+
+    def lower_window(self):
+
+        """
+        desc:
+            Returns the time (s) before a deadline from which the switch
+            interval is lowered: the longest time the thread may wait for the
+            GIL with the original interval, plus the busy wait and a margin.
+        """
+
+        return self.switch_interval.original() + self.spin_time + self.lower_margin
+
+    def _lower_switch_interval(self, deadline):
+
+        # Called with the lock held. The thread that adds a deadline within
+        # the window lowers the switch interval itself: the scheduler thread
+        # may not get the GIL in time. Later deadlines are left to the
+        # scheduler thread, that wakes up at the start of the window.
+        if not self._lowered and deadline - time.perf_counter() <= self.lower_window():
+            self.switch_interval.lower()
+            self._lowered = True
+
+    def _restore_switch_interval(self):
+
+        # Called with the lock held
+        if self._lowered:
+            self.switch_interval.restore()
+            self._lowered = False
+
+    def _clear_edges(self):
+
+        # Called with the lock held. The markers that are dropped from the
+        # queue are not written, their futures are cancelled.
+        for deadline, value, future in self._edges:
+            if future is not None:
+                future.cancel()
+        self._edges.clear()
+
+    def _wait_for_sequence(self):
+
+        # Called with the lock held, by others than the scheduler thread
+        if threading.current_thread() is self:
+            return
+        while self._sequence:
+            self._cond.wait()
+
+    def raise_error(self):
+
+        """
+        desc:
+            Re-raises an error that occurred while resetting in the background.
+        """
+
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def drain(self):
+
+        """
+        desc:
+            Waits for a pending reset and stops the thread.
+        """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.is_alive():
+            self.join()
+        self.raise_error()
+
+    def run(self):
+
+        try:
+            self._run()
+        finally:
+            if self._lowered:
+                self.switch_interval.restore()
+
+    def _run(self):
+
+        while True:
+            with self._cond:
+                while not self._edges and not self._stopped:
+                    self._restore_switch_interval()
+                    self._cond.wait()
+                if not self._edges:
+                    return
+                pulse_id = self._pulse_id
+                deadline, value, future = self._edges[0]
+                remaining = deadline - time.perf_counter()
+                window = self.lower_window()
+                if remaining > window:
+                    # The main thread keeps the original switch interval
+                    # until the start of the window before the deadline
+                    self._restore_switch_interval()
+                    self._cond.wait(remaining - window)
+                    continue
+                self._lower_switch_interval(deadline)
+                if remaining > self.spin_time:
+                    # Sleep until shortly before the deadline, a new marker
+                    # value or stop request wakes the thread up earlier.
+                    self._cond.wait(remaining - self.spin_time)
+                    continue
+
+            # Busy wait for the last part, to keep the jitter well below 1 ms
+            while time.perf_counter() < deadline:
+                pass
+
+            with self._cond:
+                if pulse_id != self._pulse_id or not self._edges:
+                    # The pulse was overruled by a new marker value
+                    continue
+                if self.min_duration is not None and time.perf_counter() < self._last_write + self.min_gap():
+                    # Queued write mode: the previous write was late, so this
+                    # write is moved back to keep the minimum duration
+                    self._edges[0] = (self._last_write + self.min_gap(), value, future)
+                    continue
+                self._edges.popleft()
+                try:
+                    if value is not None:
+                        time_ms = self._write(value)
+                        if future is not None:
+                            future.set_result(time_ms)
+                except Exception as e:
+                    self._error = e
+                    if future is not None:
+                        future.set_exception(e)
+                    self._clear_edges()
+                if self._sequence and not self._edges:
+                    # End of a sequence
+                    self._sequence = False
+                    self._cond.notify_all()
+
+    def write_start_ns(self, time_ms):
+
+        """
+        desc:
+            Returns the perf_counter_ns at the start of the write of the marker
+            with time time_ms, or None when it was not (yet) written.
+        """
+
+        record = self.marker_store.last()
+        if record is None or record['time_ms'] != time_ms:
+            return None
+        return int(record['write_start_ns'])
+
+    def log_broadcast(self, time_ms, value, skew_ms):
+
+        """
+        desc:
+            Records the skew of this device for a marker that was sent to
+            multiple devices at once (time_ms is the same for all devices).
+        """
+
+        self.broadcast_skews.append((time_ms, value, skew_ms))
+        if self.marker_log is not None:
+            self.marker_log.log_broadcast(time_ms, value, skew_ms)
+
+    def latency_summary(self):
+
+        """
+        desc:
+            Returns a dict with percentiles of the write latency (us).
+        """
+
+        import numpy
+
+        records = self.marker_store.records(include_spilled=True)
+        records = records[records['error'] == 0]
+        latency_us = (records['write_end_ns'] - records['write_start_ns']) / 1000
+        if latency_us.size == 0:
+            return {'writes': 0}
+        p50, p95, p99 = numpy.percentile(latency_us, [50, 95, 99])
+        return {'writes': latency_us.size,
+                'p50_latency_us': p50,
+                'p95_latency_us': p95,
+                'p99_latency_us': p99,
+                'max_latency_us': latency_us.max()}
+
+    def check_marker(self, value, start_ns):
+
+        """
+        desc:
+            Returns the marker error of writing value now (as checked by the
+            marker manager), or None.
+        """
+
+        if value != 0 and value == self._last_value:
+            return "The same marker value is sent twice in a row"
+        duration_ms = (start_ns / 1e9 - self._last_write) * 1000
+        if self._last_value not in (None, 0) and duration_ms < self.min_marker_duration:
+            return f"The marker duration is too short ({duration_ms:.1f} ms)"
+        return None
+
+    def marker_table(self):
+
+        """
+        desc:
+            Returns a DataFrame with the time, value, duration (until the
+            next marker) and write latency of each marker written to the
+            device, and the skew of the markers that were sent to multiple
+            devices at once (see log_broadcast, NaN for other markers).
+        """
+
+        import numpy
+        import pandas
+
+        records = self.marker_store.records(include_spilled=True)
+        records = records[records['error'] == 0]
+        duration_ms = numpy.append(numpy.diff(records['time_ms']), numpy.nan)
+        table = pandas.DataFrame({'time_ms': records['time_ms'], 'value': records['value'],
+                                  'duration_ms': duration_ms,
+                                  'write_latency_us': (records['write_end_ns'] - records['write_start_ns']) / 1000,
+                                  'skew_ms': numpy.nan})
+        if self.broadcast_skews:
+            # The broadcast has the same time in the marker table of each device
+            skews = pandas.DataFrame(self.broadcast_skews, columns=['time_ms', 'value', 'skew_ms'])
+            skews = skews.drop_duplicates(['time_ms', 'value'], keep='last').set_index(['time_ms', 'value'])
+            index = pandas.MultiIndex.from_arrays([table['time_ms'], table['value']])
+            table['skew_ms'] = skews['skew_ms'].reindex(index).to_numpy()
+        return table
+
+    def error_table(self):
+
+        """
+        desc:
+            Returns a DataFrame with the marker errors.
+        """
+
+        import pandas
+
+        return pandas.DataFrame(self.errors, columns=['time_ms', 'value', 'message'])
+
+    def _write(self, value, time_ms=None):
+
+        start_ns = time.perf_counter_ns()
+        marker_error = self.check_marker(value, start_ns)
+        try:
+            self.marker_manager.set_value(value)
+        except Exception as e:
+            end_ns = time.perf_counter_ns()
+            if time_ms is None:
+                time_ms = self.time_function_ms()
+            self.marker_store.append(time_ms, value, start_ns, end_ns, 1)
+            self.summary.add(time_ms, value, error=True)
+            self.errors.append((time_ms, value, str(e)))
+            if self.marker_log is not None:
+                self.marker_log.log_error(time_ms, value, str(e))
+            if self.live_feed is not None:
+                self.live_feed.add(time_ms, value, error=True)
+            raise
+        end_ns = time.perf_counter_ns()
+        self._last_write = end_ns / 1e9
+        self._last_value = value
+        if time_ms is None:
+            time_ms = self.time_function_ms()
+        self._last_time_ms = time_ms
+        self.marker_store.append(time_ms, value, start_ns, end_ns)
+        self.summary.add(time_ms, value)
+        if self.marker_log is not None:
+            self.marker_log.log_marker(time_ms, value, (end_ns - start_ns) / 1000)
+        if marker_error is not None:
+            # Written, the marker manager only recorded the error
+            self.errors.append((time_ms, value, marker_error))
+            if self.marker_log is not None:
+                self.marker_log.log_error(time_ms, value, marker_error)
+        if self.live_feed is not None:
+            self.live_feed.add(time_ms, value)
+        return time_ms
+
+
+class FlipLock:
+    """
+    Writes pending markers right after the next canvas flip, with the time
+    stamp of the flip as the time of the marker. The show method of the
+    canvas back-end is wrapped when the first flip-locked marker is prepared,
+    and restored at the end of the experiment.
+    """
+
+    def __init__(self, experiment):
+
+        self.experiment = experiment
+        self.pending = []
+        self._originals = {}
+
+    def install(self):
+
+        """
+        desc:
+            Wraps the show method (and the macOS variant of the legacy
+            back-end) of the canvas back-end of the experiment.
+        """
+
+        if self._originals:
+            return
+
+        from openexp import backend
+
+        canvas_class = backend.get_backend_class(self.experiment, u'canvas')
+        for name in ('show', '_show_macos'):
+            original = canvas_class.__dict__.get(name)
+            if original is not None:
+                self._originals[name] = (canvas_class, original)
+                setattr(canvas_class, name, self._wrap(original))
+
+    def _wrap(self, show):
+
+        flip_lock = self
+
+        def show_and_send(canvas, *args, **kwargs):
+            timestamp = show(canvas, *args, **kwargs)
+            if flip_lock.pending:
+                flip_lock.flip(timestamp)
+            return timestamp
+
+        return show_and_send
+
+    def add(self, send):
+
+        """
+        desc:
+            Adds a function that sends a marker, it is called with the time
+            stamp of the next flip.
+        """
+
+        self.pending.append(send)
+
+    def flip(self, timestamp):
+
+        pending, self.pending = self.pending, []
+        for send in pending:
+            send(timestamp)
+
+    def uninstall(self):
+
+        """
+        desc:
+            Restores the show method of the canvas back-end.
+        """
+
+        if self.pending:
+            print(f"WARNING: {len(self.pending)} flip-locked marker(s) not sent, no canvas was shown after them.")
+            self.pending = []
+        for name, (canvas_class, original) in self._originals.items():
+            setattr(canvas_class, name, original)
+        self._originals = {}
+
+
+class AsyncMarkerSender:
+    """
+    Sends markers from inline_script items without blocking: the writes are
+    done through the pulse scheduler on a dedicated thread with its own
+    asyncio event loop. send and pulse return a concurrent.futures.Future
+    that resolves with the time (ms) of the marker; send_async and
+    pulse_async can be awaited in the event loop of the script. In queued
+    write mode, the future of a deferred marker resolves when the marker is
+    written, and that of a skipped marker with the time of the previous
+    marker with the same value.
+
+    Example (device tag marker_device_1):
+
+        sender = experiment.markers_async_marker_device_1
+        sender.pulse(10, 20)                          # fire and forget
+        time_ms = await sender.send_async(20)         # in a coroutine
+        time_ms = sender.send(0).result()             # wait for the write
+    """
+
+    def __init__(self, scheduler):
+
+        self.scheduler = scheduler
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+
+        import asyncio
+
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self.loop.run_forever, name='markers_async_sender')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _submit(self, function, *args):
+
+        # A plain callback (not a task), so writes run in order and before a stop request
+        if self.loop is None:
+            self._start()
+        future = Future()
+
+        def resolve(written):
+            try:
+                future.set_result(written.result())
+            except Exception as e:
+                future.set_exception(e)
+
+        def write():
+            if future.set_running_or_notify_cancel():
+                try:
+                    time_ms = function(*args)
+                except Exception as e:
+                    future.set_exception(e)
+                    return
+                if isinstance(time_ms, Future):
+                    # Queued write mode: the marker is written later by the pulse scheduler
+                    time_ms.add_done_callback(resolve)
+                else:
+                    future.set_result(time_ms)
+
+        self.loop.call_soon_threadsafe(write)
+        return future
+
+    def send(self, value):
+
+        """
+        desc:
+            Sets the marker value, returns a Future with the time (ms) of the marker.
+        """
+
+        return self._submit(self.scheduler.set_value, int(value))
+
+    def pulse(self, value, duration):
+
+        """
+        desc:
+            Sets the marker value and resets it to 0 after duration (ms),
+            returns a Future with the time (ms) of the marker.
+        """
+
+        return self._submit(self.scheduler.pulse, int(value), duration)
+
+    async def send_async(self, value):
+
+        import asyncio
+
+        return await asyncio.wrap_future(self.send(value))
+
+    async def pulse_async(self, value, duration):
+
+        import asyncio
+
+        return await asyncio.wrap_future(self.pulse(value, duration))
+
+    def close(self):
+
+        """
+        desc:
+            Finishes the pending writes and stops the event loop thread.
+        """
+
+        with self._lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
 
 
 class markers_os3_init(item):
@@ -38,6 +1406,17 @@ class markers_os3_init(item):
         self.var.marker_dummy_mode = u'no'
         self.var.marker_gen_mark_file = u'yes'
         self.var.marker_flash_255 = u'no'
+        self.var.marker_device_cache = u'use'
+        self.var.marker_stream_log = u'no'
+        self.var.marker_store_limit = 0
+        self.var.marker_binary_file = u'no'
+        self.var.marker_time_source = u'opensesame'
+        self.var.marker_flash_duration = 100
+        self.var.marker_settle_time = 100
+        self.var.marker_keep_connection = u'no'
+        self.var.marker_queued_writes = u'no'
+        self.var.marker_min_duration = 10
+        self._connection = None
 
     def get_device_gui(self):
         if self.var.marker_device == u'UsbParMarker':
@@ -56,6 +1435,63 @@ class markers_os3_init(item):
     def get_serial_gui(self):
         return self.var.marker_device_serial
 
+    def get_device_cache_gui(self):
+        if self.var.marker_device_cache in (u'use', u'refresh', u'off'):
+            return self.var.marker_device_cache
+        raise osexception(f"Incorrect device cache setting: {self.var.marker_device_cache}")
+
+    def get_stream_log_gui(self):
+        return self.var.marker_stream_log == u'yes'
+
+    def get_store_limit_gui(self):
+        try:
+            max_markers = int(self.var.marker_store_limit)
+        except ValueError:
+            raise osexception(f"Incorrect marker store limit: {self.var.marker_store_limit}")
+        if max_markers < 0:
+            raise osexception("Marker store limit must be a positive number (0: no limit)")
+        return max_markers
+
+    def get_binary_file_gui(self):
+        if self.var.marker_binary_file in (u'no', u'feather', u'parquet', u'npy'):
+            return self.var.marker_binary_file
+        raise osexception(f"Incorrect binary marker file setting: {self.var.marker_binary_file}")
+
+    def get_min_duration_gui(self):
+
+        """
+        desc:
+            Returns the minimum marker duration (s) in queued write mode, or
+            None when queued write mode is off.
+        """
+
+        if self.var.marker_queued_writes != u'yes':
+            return None
+        return self.get_time_setting_gui(u'marker_min_duration', u'Minimum marker duration') / 1000
+
+    def get_keep_connection_gui(self):
+        return self.var.marker_keep_connection == u'yes'
+
+    def get_time_source_gui(self):
+        if self.var.marker_time_source in (u'opensesame', u'perf_counter', u'both'):
+            return self.var.marker_time_source
+        raise osexception(f"Incorrect time source setting: {self.var.marker_time_source}")
+
+    def get_flash_duration_gui(self):
+        return self.get_time_setting_gui(u'marker_flash_duration', u'Flash duration')
+
+    def get_settle_time_gui(self):
+        return self.get_time_setting_gui(u'marker_settle_time', u'Settle time')
+
+    def get_time_setting_gui(self, var_name, label):
+        try:
+            duration = float(self.var.get(var_name))
+        except ValueError:
+            raise osexception(f"Incorrect {label.lower()}: {self.var.get(var_name)}")
+        if duration < 0:
+            raise osexception(f"{label} must be a positive number")
+        return duration
+
     def get_tag_gui(self):
         return self.var.marker_device_tag
 
@@ -89,6 +1525,65 @@ class markers_os3_init(item):
             except:
                 pass
 
+    def get_pulse_scheduler_var(self):
+        return getattr(self.experiment, f"markers_scheduler_{self.get_tag_gui()}", None)
+
+    def set_pulse_scheduler_var(self, scheduler):
+        setattr(self.experiment, f"markers_scheduler_{self.get_tag_gui()}", scheduler)
+
+    def get_async_sender_var(self):
+        return getattr(self.experiment, f"markers_async_{self.get_tag_gui()}", None)
+
+    def set_async_sender_var(self, sender):
+        setattr(self.experiment, f"markers_async_{self.get_tag_gui()}", sender)
+
+    def get_switch_interval(self):
+
+        """
+        desc:
+            Returns the switch interval shared by the pulse schedulers of all
+            marker devices of the experiment.
+        """
+
+        switch_interval = getattr(self.experiment, "markers_switch_interval", None)
+        if switch_interval is None:
+            switch_interval = SwitchInterval()
+            setattr(self.experiment, "markers_switch_interval", switch_interval)
+        return switch_interval
+
+    def get_marker_log_var(self):
+        return getattr(self.experiment, f"markers_log_{self.get_tag_gui()}", None)
+
+    def set_marker_log_var(self, marker_log):
+        setattr(self.experiment, f"markers_log_{self.get_tag_gui()}", marker_log)
+
+    def get_log_location(self):
+        return os.path.dirname(os.path.abspath(self.experiment.logfile))
+
+    def get_marker_file_name(self, suffix):
+        return 'subject-' + str(self.experiment.var.subject_nr) + '_' + self.get_tag_gui() + '_' + suffix
+
+    def set_latency_summary_var(self, latency_summary):
+        setattr(self.experiment.var, f"markers_latency_summary_{self.get_tag_gui()}", latency_summary)
+
+    def get_clock_sync_var(self):
+        return getattr(self.experiment, f"markers_clock_sync_{self.get_tag_gui()}", None)
+
+    def set_clock_sync_var(self, clock_sync):
+        setattr(self.experiment, f"markers_clock_sync_{self.get_tag_gui()}", clock_sync)
+
+    def set_clock_sync_table_var(self, clock_sync_table):
+        setattr(self.experiment.var, f"markers_clock_sync_table_{self.get_tag_gui()}", clock_sync_table)
+
+    def set_deferral_table_var(self, deferral_table):
+        setattr(self.experiment.var, f"markers_deferral_table_{self.get_tag_gui()}", deferral_table)
+
+    def set_marker_file_var(self, path):
+        setattr(self.experiment.var, f"markers_file_{self.get_tag_gui()}", path)
+
+    def set_binary_file_var(self, path):
+        setattr(self.experiment.var, f"markers_binary_file_{self.get_tag_gui()}", path)
+
     def set_marker_prop_var(self, marker_prop):
         setattr(self.experiment.var, f"markers_prop_{self.get_tag_gui()}", marker_prop)
 
@@ -118,22 +1613,47 @@ class markers_os3_init(item):
 
         # Check input of plugin:
         device_tag = self.get_tag_gui()
-        if not(bool(re.match("^[A-Za-z0-9_-]*$", device_tag)) and bool(re.match("^[A-Za-z]*$", device_tag[0]))):
+        if not isinstance(device_tag, str) or TAG_PATTERN.match(device_tag) is None:
             # Raise error, tag can only contain: letters, numbers, underscores and dashes and should start with letter.
             raise osexception(f"Incorrect device tag: {device_tag}. "
                               "Device tag can only contain letters, numbers, underscores and dashes "
                               "and should start with a letter.")
 
         device_address = self.get_addr_gui()
-        if device_address != u'ANY' and re.match("^COM\d{1,3}", str(device_address)) is None:
+        if device_address != u'ANY' and ADDR_PATTERN.match(str(device_address)) is None:
             # Raise error when marker address is not a proper COM address.
             raise osexception(f"Incorrect marker device address: {device_address}")
 
+        # Check marker store limit and binary marker file setting
+        self.get_store_limit_gui()
+        self.get_binary_file_gui()
+        self.get_time_source_gui()
+        self.get_flash_duration_gui()
+        self.get_settle_time_gui()
+        self.get_min_duration_gui()
+
         # Add tag to marker manager tag list:
         self.set_marker_manager_tag_var()
 
+        # Flip lock for flip-locked markers_os3_send items, shared by all devices
+        if getattr(self.experiment, "markers_flip_lock", None) is None:
+            flip_lock = FlipLock(self.experiment)
+            setattr(self.experiment, "markers_flip_lock", flip_lock)
+            self.experiment.cleanup_functions.append(flip_lock.uninstall)
+
+        # Get the open connection of a previous run, when kept open
+        self._connection = None
+        if self.get_keep_connection_gui():
+            self._connection = connection_pool().acquire(self.get_connection_key())
+            if self._connection is not None:
+                # Return it to the pool, also when the experiment does not get to run this item
+                self.experiment.cleanup_functions.append(self.release_connection)
+
         # Get com port
-        if self.get_dummy_mode_gui():
+        if self._connection is not None:
+            com_port = self._connection.com_port
+            device = self._connection.device
+        elif self.get_dummy_mode_gui():
             com_port = 'FAKE'
             device = 'FAKE DEVICE'
         else:
@@ -161,30 +1681,92 @@ class markers_os3_init(item):
             # Raise error since you cannot init twice.
             raise osexception("Marker device already initialized.")
 
-        # Build marker manager:
-        marker_manager = mark.MarkerManager(device_type=device,
-                                            device_address=com_port,
-                                            crash_on_marker_errors=self.get_crash_on_mark_error_gui(),
-                                            time_function_ms=lambda: self.time())
+        # Time source of the marker time stamps: the OpenSesame clock, or
+        # perf_counter_ns mapped to the OpenSesame clock (with drift fit for 'both')
+        clock_sync = None
+        if self.get_time_source_gui() == u'opensesame':
+            time_function_ms = self.clock.time
+        else:
+            clock_sync = ClockSync(self.clock.time)
+            if self.get_time_source_gui() == u'both':
+                clock_sync.start()
+            time_function_ms = clock_sync.time_ms
+        self.set_clock_sync_var(clock_sync)
+
+        # Build marker manager, or use the connection that was kept open:
+        if self._connection is not None:
+            marker_manager = self._connection.marker_manager
+            self._connection.start_run(time_function_ms)
+            print(f"Using open connection to marker device on {com_port}.")
+        elif self.get_keep_connection_gui():
+            self._connection = connection_pool().PooledConnection(self.get_connection_key(), None, device,
+                                                                  com_port, time_function_ms)
+            marker_manager = marker_management().MarkerManager(device_type=device,
+                                                device_address=com_port,
+                                                crash_on_marker_errors=self.get_crash_on_mark_error_gui(),
+                                                time_function_ms=self._connection.time_ms)
+            self._connection.marker_manager = marker_manager
+            self._connection.start_run(time_function_ms)
+        else:
+            marker_manager = marker_management().MarkerManager(device_type=device,
+                                                device_address=com_port,
+                                                crash_on_marker_errors=self.get_crash_on_mark_error_gui(),
+                                                time_function_ms=time_function_ms)
         self.set_marker_manager_var(marker_manager)
 
         # Create marker_prop (dict with marker manager properties)
         marker_prop = marker_manager.device_properties
         self.set_marker_prop_var(marker_prop)
 
-        # Flash 255
-        pulse_dur = 100
+        # Start streaming marker log
+        marker_log = None
+        if self.get_stream_log_gui():
+            try:
+                marker_log = MarkerLogWriter(os.path.join(self.get_log_location(),
+                                                          self.get_marker_file_name('marker_log') + '.tsv'))
+                marker_log.start()
+            except OSError:
+                print(f"WARNING: Could not create marker log: {sys.exc_info()[1]}")
+        self.set_marker_log_var(marker_log)
+
+        # Marker store, with a limited number of markers in its arrays when specified
+        max_markers = self.get_store_limit_gui()
+        if max_markers:
+            marker_store = MarkerStore(max_chunks=max(1, math.ceil(max_markers / MarkerStore.chunk_size)),
+                                       spill_path=os.path.join(self.get_log_location(),
+                                                               self.get_marker_file_name('marker_store') + '.bin'))
+        else:
+            marker_store = MarkerStore()
+
+        # Live feed for the Markers tab of the extension, sent with the workspace
+        live_feed = LiveFeed(self.get_tag_gui())
+        self.python_workspace[f"markers_live_{self.get_tag_gui()}"] = live_feed
+
+        # Start pulse scheduler, all marker values are set through the scheduler
+        scheduler = PulseScheduler(marker_manager, time_function_ms, marker_log, marker_store, live_feed,
+                                   self.get_min_duration_gui(), self.get_switch_interval(),
+                                   self.get_crash_on_mark_error_gui())
+        scheduler.start()
+        self.set_pulse_scheduler_var(scheduler)
+
+        # Non-blocking send API for inline_script items
+        self.set_async_sender_var(AsyncMarkerSender(scheduler))
+
+        # Flash 255 and reset, as a sequence that runs while the experiment
+        # continues (markers sent in the meantime wait for it)
+        flash_duration = self.get_flash_duration_gui()
+        edges = []
         if self.var.marker_flash_255 == 'yes':
-            marker_manager.set_value(255)
-            self.sleep(pulse_dur)
-            marker_manager.set_value(0)
-            self.sleep(pulse_dur)
-            marker_manager.set_value(255)
-            self.sleep(pulse_dur)
-
-        # Reset:
-        marker_manager.set_value(0)
-        self.sleep(pulse_dur)
+            edges = [(0, 255), (flash_duration, 0), (2 * flash_duration, 255)]
+        edges.append((len(edges) * flash_duration, 0))
+        if edges == [(0, 0)] and self._connection is not None and self._connection.runs > 1:
+            # A connection that was kept open was already reset at the end of the previous run
+            pass
+        else:
+            # The settle time is a fixed delay after the reset: python_markers
+            # cannot read back the marker value of the device
+            edges.append((edges[-1][0] + self.get_settle_time_gui(), None))
+            scheduler.schedule(edges)
 
         # Add cleanup function:
         self.experiment.cleanup_functions.append(self.cleanup)
@@ -193,29 +1775,94 @@ class markers_os3_init(item):
 
     def cleanup(self):
 
+        import pandas
+
+        # Wait for pending markers of inline scripts and pending pulses (in
+        # queued write mode, the reset is queued after the pending markers):
+        self.get_async_sender_var().close()
+        scheduler = self.get_pulse_scheduler_var()
+        try:
+            if scheduler.min_duration is not None:
+                scheduler.set_value(0)
+            scheduler.drain()
+        except:
+            print(f"WARNING: Error while resetting marker: {sys.exc_info()[1]}")
+
         # Reset value:
-        self.get_marker_manager_var().set_value(0)
-        self.sleep(100)
+        if scheduler.min_duration is None:
+            scheduler.set_value(0)
+        self.sleep(self.get_settle_time_gui())
+
+        # Stop sampling the clocks, the final fit is included in the summaries
+        clock_sync = self.get_clock_sync_var()
+        clock_summary = {}
+        if clock_sync is not None and clock_sync.is_alive():
+            clock_sync.stop()
+        if clock_sync is not None and len(clock_sync.samples) > 1:
+            clock_summary = clock_sync.summary()
+
+        # Summary per marker value, kept up to date while the markers were
+        # sent, and the markers of this run as kept by the scheduler (the
+        # marker manager is not scanned again)
+        summary_df = pandas.DataFrame(scheduler.summary.rows(), columns=SUMMARY_COLUMNS)
+        latency_summary = scheduler.latency_summary()
+        marker_df, error_df = scheduler.marker_table(), scheduler.error_table()
+
+        # Close streaming marker log, it replaces the marker file. The summary
+        # file also has the error table, with the errors that the marker
+        # manager only recorded (they are also in the marker log).
+        marker_log = self.get_marker_log_var()
+        if marker_log is not None:
+            marker_log.close()
+            self.set_marker_file_var(marker_log.path)
+            try:
+                with open(os.path.join(self.get_log_location(),
+                                       self.get_marker_file_name('marker_summary') + '.tsv'), 'w', newline='') as f:
+                    summary_df.to_csv(f, sep='\t', index=False)
+                    f.write('\n')
+                    pandas.DataFrame([{**latency_summary, **clock_summary}]).to_csv(f, sep='\t', index=False)
+                    f.write('\n')
+                    error_df.to_csv(f, sep='\t', index=False)
+            except:
+                print("WARNING: Could not save marker summary file.")
 
-        # Generate and save marker file in same location as the logfile
-        if self.var.marker_gen_mark_file == u'yes':
-            log_location = os.path.dirname(os.path.abspath(self.experiment.logfile))
+        # Generate and save marker file in same location as the logfile, with
+        # the same summary as the Marker tables tab
+        elif self.var.marker_gen_mark_file == u'yes':
             try:
-                full_filename = 'subject-' + str(self.experiment.var.subject_nr) + '_' + self.get_tag_gui() + '_marker_table'
-                self.get_marker_manager_var().save_marker_table(filename=full_filename,
-                                                            location=log_location,
-                                                            more_info={'Device tag': self.get_tag_gui(),
-                                                                    'Subject': self.experiment.var.subject_nr})
+                path = os.path.join(self.get_log_location(), self.get_marker_file_name('marker_table') + '.tsv')
+                save_marker_file(path, {'Device tag': self.get_tag_gui(),
+                                        'Subject': self.experiment.var.subject_nr,
+                                        **latency_summary,
+                                        **clock_summary}, (summary_df, marker_df, error_df))
+                self.set_marker_file_var(path)
             except:
                 print("WARNING: Could not save marker file.")
 
+        # Save the markers as a binary columnar file, for fast loading of many subjects
+        if self.get_binary_file_gui() != u'no':
+            try:
+                self.set_binary_file_var(scheduler.marker_store.save(
+                    os.path.join(self.get_log_location(), self.get_marker_file_name('marker_data')),
+                    self.get_binary_file_gui()))
+            except:
+                print(f"WARNING: Could not save binary marker file: {sys.exc_info()[1]}")
 
-        # Close marker device:
-        self.close()
-
-        # Get marker tables and save in var
-        marker_df, summary_df, error_df = self.get_marker_manager_var().gen_marker_table()
+        # Save marker tables in var
         self.set_marker_tables_var(marker_df, summary_df, error_df)
+        self.set_latency_summary_var(pandas.DataFrame([latency_summary]))
+        if clock_summary:
+            self.set_clock_sync_table_var(pandas.DataFrame(clock_sync.table(), columns=[
+                'perf_counter_ms', 'opensesame_ms', 'fitted_ms', 'residual_ms', 'sample_duration_us']))
+        if scheduler.deferrals:
+            self.set_deferral_table_var(pandas.DataFrame(scheduler.deferrals,
+                                                         columns=['time_ms', 'value', 'delay_ms', 'action']))
+
+        # Close marker device, or keep the connection open for the next run:
+        if self._connection is not None:
+            self.release_connection()
+        else:
+            self.close()
 
     def close(self):
 
@@ -230,6 +1877,49 @@ class markers_os3_init(item):
         except:
             pass
 
+    def release_connection(self):
+
+        """
+        desc:
+            Returns the connection to the connection pool, for the next run.
+        """
+
+        if self._connection is not None:
+            connection_pool().release(self._connection)
+
+    def get_device_discovery(self):
+
+        """
+        desc:
+            Returns the device discovery of the experiment, starts it when
+            this is the first markers_os3_init item that needs it.
+        """
+
+        discovery = getattr(self.experiment, "markers_device_discovery", None)
+        if discovery is None:
+            discovery = DeviceDiscovery()
+            setattr(self.experiment, "markers_device_discovery", discovery)
+        return discovery
+
+    def get_connection_key(self):
+
+        return connection_pool().pool_key(self.get_tag_gui(), self.get_device_gui(), self.get_addr_gui(),
+                                          self.get_serial_gui(), self.get_dummy_mode_gui(),
+                                          self.get_crash_on_mark_error_gui())
+
+    def get_used_com_ports(self):
+
+        """
+        desc:
+            Returns the com ports of the other marker devices of the experiment.
+        """
+
+        used_ports = []
+        for tag in getattr(self.experiment.var, "markers_tags", []):
+            if tag != self.get_tag_gui():
+                used_ports.append(getattr(self.experiment.var, f"markers_com_port_{tag}", None))
+        return used_ports
+
     def resolve_com_port(self):
 
         """
@@ -252,15 +1942,46 @@ class markers_os3_init(item):
         else:
             serialno = self.get_serial_gui()
 
-        # Find device
+        # The cache is only used when the address is not given
+        cache_mode = self.get_device_cache_gui()
+        use_cache = cache_mode != u'off' and addr == ''
+        cache_key = device_cache_key(device_type, serialno)
+        used_ports = self.get_used_com_ports()
+
+        if use_cache:
+            cache = read_device_cache()
+            cached_info = cache.get(cache_key)
+            if cache_mode == u'refresh':
+                cached_info = None
+            if cached_info is not None and cached_info['com_port'] not in used_ports:
+                # Try cached port first, only this port is checked
+                try:
+                    return marker_management().find_device(device_type=device_type,
+                                                           serial_no=serialno,
+                                                           com_port=cached_info['com_port'],
+                                                           fallback_to_fake=False)
+                except:
+                    print(f"Marker device not found on cached port {cached_info['com_port']}, "
+                          "searching all ports.")
+                    clear_device_cache(cache_key)
+
+        # Find device, all ports are probed concurrently when searching for any device
         try:
-            device_info = mark.find_device(device_type=device_type,
-                                           serial_no=serialno,
-                                           com_port=addr,
-                                           fallback_to_fake=False)
+            if device_type == '' and serialno == '' and addr == '':
+                device_info = self.get_device_discovery().find(exclude_ports=used_ports)
+            else:
+                device_info = marker_management().find_device(device_type=device_type,
+                                                              serial_no=serialno,
+                                                              com_port=addr,
+                                                              fallback_to_fake=False)
         except:
             raise osexception(f"Marker device init error: {sys.exc_info()[1]}")
 
+        if use_cache:
+            cache = read_device_cache()
+            cache[cache_key] = device_info
+            write_device_cache(cache)
+
         return device_info
 
 
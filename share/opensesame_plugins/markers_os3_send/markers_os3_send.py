@@ -8,11 +8,14 @@ from libopensesame.py3compat import *
 from libopensesame.item import item
 from libqtopensesame.items.qtautoplugin import qtautoplugin
 from libopensesame.exceptions import osexception
-import serial
 import sys
 import re
-import os
-import pandas
+from concurrent.futures import ThreadPoolExecutor
+
+# Device tag: letters, numbers, underscores and dashes, starting with a letter
+TAG_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_-]*$")
+# Variable reference in a marker value, e.g. [marker_value]
+REFERENCE_PATTERN = re.compile(r"\[(\w+)\]")
 
 
 class markers_os3_send(item):
@@ -32,6 +35,20 @@ class markers_os3_send(item):
         self.var.marker_value = 0
         self.var.marker_object_duration = 0
         self.var.marker_reset_to_zero = 'no'
+        self.var.marker_pulse_mode = 'no'
+        self.var.marker_flip_locked = 'no'
+
+        # Cached results of prepare
+        self._checked_tag = None
+        self._checked_tags = []
+        self._checked_duration = None
+        self._device_tags = None
+        self._writers = []
+        self._executor = None
+        self._loop = None
+        self._loop_dm = None
+        self._loop_values = None
+        self._loop_cells = None
 
     def get_tag(self):
         return self.var.marker_device_tag
@@ -43,7 +60,13 @@ class markers_os3_send(item):
         return self.var.marker_object_duration
     
     def get_reset_to_zero(self):
-        return self.var.marker_reset_to_zero == u'yes'    
+        return self.var.marker_reset_to_zero == u'yes'
+
+    def get_pulse_mode(self):
+        return self.var.marker_pulse_mode == u'yes'
+
+    def get_flip_locked(self):
+        return self.var.marker_flip_locked == u'yes'
 
     def is_already_init(self):
         try:
@@ -57,6 +80,214 @@ class markers_os3_send(item):
         else:
             return None
 
+    def get_tags(self):
+
+        """
+        desc:
+            Returns the list of device tags to send the marker to. ALL sends
+            the marker to all initialized marker devices.
+        """
+
+        if self._checked_tags == [u'ALL']:
+            try:
+                return list(self.experiment.var.markers_tags)
+            except:
+                return []
+        return self._checked_tags
+
+    def get_writers(self):
+
+        """
+        desc:
+            Returns the objects that set the marker value of each device: the
+            pulse scheduler of the init item, or else the marker manager.
+            They are looked up once and cached until the device tags change.
+        """
+
+        device_tags = self.get_tags()
+        if device_tags != self._device_tags or None in self._writers or not self._writers:
+            self._writers = []
+            for device_tag in device_tags:
+                writer = getattr(self.experiment, f"markers_scheduler_{device_tag}", None)
+                if writer is None:
+                    writer = getattr(self.experiment, f"markers_{device_tag}", None)
+                self._writers.append(writer)
+            self._device_tags = device_tags
+        return self._writers
+
+    def get_executor(self, n_devices):
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=n_devices)
+            self.experiment.cleanup_functions.append(self._executor.shutdown)
+        return self._executor
+
+    def write_all(self, writers, method, *args, time_ms=None):
+
+        """
+        desc:
+            Calls method (set_value or pulse) of all writers. The pulse
+            schedulers get time_ms (when given, e.g. the time of a canvas flip),
+            so with multiple devices the marker has the same time in the marker
+            table of each device. The writes to multiple devices are done
+            concurrently and the skew between the starts of the writes is
+            recorded by the pulse scheduler of each device.
+        """
+
+        if time_ms is None and len(writers) > 1:
+            time_ms = writers[0].time_function_ms() if hasattr(writers[0], 'time_function_ms') else self.time()
+        calls = [(getattr(writer, method), {'time_ms': time_ms} if hasattr(writer, 'log_broadcast') else {})
+                 for writer in writers]
+
+        if len(writers) == 1:
+            function, kwargs = calls[0]
+            function(*args, **kwargs)
+            return
+
+        executor = self.get_executor(len(writers))
+        futures = [executor.submit(function, *args, **kwargs) for function, kwargs in calls]
+        for future in futures:
+            future.result()
+
+        # Skew from the write start of each device (None when the marker was
+        # queued or skipped in queued write mode)
+        start_ns = [writer.write_start_ns(time_ms) if hasattr(writer, 'write_start_ns') else None
+                    for writer in writers]
+        written = [ns for ns in start_ns if ns is not None]
+        if not written:
+            return
+        first_start_ns = min(written)
+        for writer, ns in zip(writers, start_ns):
+            if ns is not None:
+                writer.log_broadcast(time_ms, args[0], (ns - first_start_ns) / 1e6)
+
+    def find_loop(self):
+
+        """
+        desc:
+            Returns the loop item that (directly, without another loop in
+            between) runs this item, or None when there is no such loop or
+            when the item is used in several loops.
+        """
+
+        loops = []
+        for loop in self.experiment.items.values():
+            if loop.item_type != u'loop':
+                continue
+            child_names = [loop._item]
+            while child_names:
+                child_name = child_names.pop()
+                if child_name == self.name:
+                    loops.append(loop)
+                    break
+                child = self.experiment.items[child_name] if child_name in self.experiment.items else None
+                if child is not None and child.item_type == u'sequence':
+                    child_names += [name for name, cond in child.items]
+        return loops[0] if len(loops) == 1 else None
+
+    def prepare_loop_values(self):
+
+        """
+        desc:
+            Evaluates the marker value for all rows of the loop table of the
+            enclosing loop at once. Invalid values and the same value sent
+            twice in a row are found before the first trial, and run can look
+            up the value of the current row.
+        """
+
+        if self._loop is None:
+            self._loop = self.find_loop()
+            if self._loop is None:
+                self._loop = False
+        if self._loop is False:
+            return
+
+        # The loop table in the order of the current run of the loop
+        loop_dm = getattr(self._loop, 'live_dm', None)
+        if loop_dm is None or loop_dm is self._loop_dm:
+            return
+        self._loop_dm = loop_dm
+        self._loop_values = None
+
+        # Only values that refer to columns of the loop table are evaluated
+        value_text = str(self.var.get(u'marker_value', _eval=False))
+        references = REFERENCE_PATTERN.findall(value_text)
+        if not references or any(name not in loop_dm.column_names for name in references):
+            return
+
+        import numpy
+
+        values = []
+        cells = []
+        for row in loop_dm:
+            cells.append(tuple(str(row[name]) for name in references))
+            text = REFERENCE_PATTERN.sub(lambda match: str(row[match.group(1)]), value_text)
+            if text.startswith(u'=') or u'[' in text:
+                # Python expressions and references to other variables (e.g.
+                # [base_code]) are evaluated by the loop at run time
+                return
+            try:
+                values.append(int(float(text)))
+            except ValueError:
+                raise osexception(f"Invalid marker value '{text}' in loop {self._loop.name}")
+        values = numpy.array(values, dtype=numpy.int64)
+
+        invalid = numpy.flatnonzero((values < 0) | (values > 255))
+        if invalid.size:
+            raise osexception(f"Invalid marker value(s) {values[invalid].tolist()} in loop {self._loop.name}: "
+                              "marker values should be between 0 and 255")
+
+        if not (self._reset_to_zero or self._pulse_mode):
+            same_value = numpy.flatnonzero(values[1:] == values[:-1]) + 1
+            if same_value.size:
+                message = (f"marker value sent twice in a row by {self.name} "
+                           f"in rows {same_value.tolist()} of loop {self._loop.name}")
+                if self.crash_on_same_value():
+                    raise osexception(f"Same marker value sent twice in a row: {message}")
+                print(f"WARNING: {message}")
+
+        self._loop_values = values
+        self._loop_cells = (references, cells)
+
+    def crash_on_same_value(self):
+
+        """
+        desc:
+            Returns True when sending the same marker value twice in a row
+            crashes the experiment: Crash on marker errors is checked for one
+            of the devices, and queued write mode (which leaves out the
+            second value) is off.
+        """
+
+        for writer in self.get_writers():
+            if (getattr(writer, 'crash_on_marker_errors', False)
+                    and getattr(writer, 'min_duration', None) is None):
+                return True
+        return False
+
+    def get_run_value(self):
+
+        """
+        desc:
+            Returns the marker value, from the loop values evaluated in prepare
+            when available. When a loop variable of the marker value was changed
+            (e.g. by an inline_script), the marker value is evaluated instead.
+        """
+
+        if self._loop_values is not None:
+            try:
+                row = self._loop.live_row
+                references, cells = self._loop_cells
+                # The loop variables are experiment variables (the item's own
+                # variable may have the same name, e.g. marker_value)
+                experiment_var = self.experiment.var
+                if all(str(experiment_var.get(name, _eval=False)) == cell
+                       for name, cell in zip(references, cells[row])):
+                    return int(self._loop_values[row])
+            except (IndexError, TypeError):
+                pass
+        return int(self.get_value())
+
     def prepare(self):
 
         """
@@ -64,20 +295,44 @@ class markers_os3_send(item):
             Prepare phase.
         """
 
-        # Check input of plugin:
+        # Check input of plugin, only when the device tag changed:
         device_tag = self.get_tag()
-        if not(bool(re.match("^[A-Za-z0-9_-]*$", device_tag)) and bool(re.match("^[A-Za-z]*$", device_tag[0]))):
-            # Raise error, tag can only contain: letters, numbers, underscores and dashes and should start with letter.
-            raise osexception("Device tag can only contain letters, numbers, underscores and dashes "
-                              "and should start with a letter.")
-        
+        if device_tag != self._checked_tag:
+            device_tags = [tag.strip() for tag in str(device_tag).split(',')]
+            for tag in device_tags:
+                if tag != u'ALL' and TAG_PATTERN.match(tag) is None:
+                    # Raise error, tag can only contain: letters, numbers, underscores and dashes and should start with letter.
+                    raise osexception("Device tag can only contain letters, numbers, underscores and dashes "
+                                      "and should start with a letter.")
+            if u'ALL' in device_tags and len(device_tags) > 1:
+                raise osexception("Device tag ALL cannot be combined with other device tags.")
+            self._checked_tag = device_tag
+            self._checked_tags = device_tags
+
         # Marker value is checked by marker_management
 
-        # Check Marker duration
-        if not(isinstance(self.get_duration(), int) and not(isinstance(self.get_duration(), float))):
-            raise osexception("Object duration should be numeric")
-        elif self.get_duration() < 0:
-            raise osexception("Object duration must be a positive number")
+        # Check Marker duration, only when the duration changed
+        duration = self.get_duration()
+        if duration != self._checked_duration or type(duration) is not type(self._checked_duration):
+            if not(isinstance(duration, int) and not(isinstance(duration, float))):
+                raise osexception("Object duration should be numeric")
+            elif duration < 0:
+                raise osexception("Object duration must be a positive number")
+            self._checked_duration = duration
+
+        # Settings used by run
+        self._pulse_mode = self.get_pulse_mode()
+        self._reset_to_zero = self.get_reset_to_zero()
+        self._flip_lock = None
+        if self.get_flip_locked():
+            self._flip_lock = getattr(self.experiment, "markers_flip_lock", None)
+            if self._flip_lock is None:
+                raise osexception("You must have a markers_os3_init item before sending flip-locked markers.")
+            # Before the canvas of the next sketchpad is prepared
+            self._flip_lock.install()
+
+        # Evaluate marker values of the loop table, when the loop was prepared again
+        self.prepare_loop_values()
 
         # Call the parent constructor.
         item.prepare(self)
@@ -89,25 +344,59 @@ class markers_os3_send(item):
             Run phase.
         """
 
+        writers = self.get_writers()
+
         # Check if the marker device is initialized
-        if not self.is_already_init():
+        if not writers or None in writers:
             raise osexception("You must have a markers_os3_init item before sending markers."
                               " Make sure the Device tags match.")
 
+        duration = self._checked_duration
+
+        # Flip-locked: the marker is sent right after the next canvas flip,
+        # the item itself returns immediately
+        if self._flip_lock is not None:
+            value = self.get_run_value()
+            if self._pulse_mode or self._reset_to_zero:
+                method, args = 'pulse', (value, duration)
+            else:
+                method, args = 'set_value', (value,)
+
+            def send(timestamp):
+                try:
+                    self.write_all(writers, method, *args, time_ms=timestamp)
+                except:
+                    raise osexception(f"Error sending marker with value {value}: {sys.exc_info()[1]}")
+                self.experiment.var.set(f"time_{self.name}", timestamp)
+
+            self._flip_lock.add(send)
+            self.set_item_onset()
+            return
+
+        # Pulse mode: the pulse scheduler resets the marker value to zero after
+        # the object duration, the item itself returns immediately
+        if self._pulse_mode and all(hasattr(writer, 'pulse') for writer in writers):
+            try:
+                self.write_all(writers, 'pulse', self.get_run_value(), duration)
+            except:
+                raise osexception(f"Error sending marker with value {self.get_value()}: {sys.exc_info()[1]}")
+            self.set_item_onset()
+            return
+
         # Send marker:
         try:
-            self.get_marker_manager().set_value(int(self.get_value()))
+            self.write_all(writers, 'set_value', self.get_run_value())
         except:
             raise osexception(f"Error sending marker with value {self.get_value()}: {sys.exc_info()[1]}")
 
         # Sleep for object duration (blocking)
-        self.sleep(int(self.get_duration()))      
+        self.sleep(duration)
 
         # Reset marker value to zero, if specified
-        if self.get_reset_to_zero():
+        if self._reset_to_zero:
 
             try:
-                self.get_marker_manager().set_value(0)
+                self.write_all(writers, 'set_value', 0)
             except:
                 raise osexception(f"Error sending marker with value 0: {sys.exc_info()[1]}")
 
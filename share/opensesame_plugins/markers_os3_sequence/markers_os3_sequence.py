@@ -0,0 +1,231 @@
+# -*- coding:utf-8 -*-
+
+"""
+OpenSesame 3 plugin for sending a sequence of markers to Leiden Univ Marker device.
+"""
+
+from libopensesame.py3compat import *
+from libopensesame.item import item
+from libqtopensesame.items.qtautoplugin import qtautoplugin
+from libopensesame.exceptions import osexception
+import sys
+import re
+
+# Device tag: letters, numbers, underscores and dashes, starting with a letter
+TAG_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_-]*$")
+# One value:duration pair of a marker sequence
+PAIR_PATTERN = re.compile(r"^\s*(\d+)\s*:\s*(\d+)\s*$")
+
+
+def parse_sequence(sequence):
+
+    """
+    desc:
+        Parses a marker sequence (value:duration pairs, separated by semicolons).
+
+    returns:
+        A list of (value, duration) tuples, duration in ms.
+    """
+
+    pairs = []
+    for pair in str(sequence).split(';'):
+        if not pair.strip():
+            continue
+        match = PAIR_PATTERN.match(pair)
+        if match is None:
+            raise osexception(f"Incorrect marker sequence element: '{pair.strip()}'. "
+                              "Use value:duration pairs separated by semicolons, e.g. 1:10; 25:10")
+        value, duration = int(match.group(1)), int(match.group(2))
+        if value > 255:
+            raise osexception(f"Marker value {value} in marker sequence should be between 0 and 255")
+        pairs.append((value, duration))
+    if not pairs:
+        raise osexception("The marker sequence is empty")
+    return pairs
+
+
+def sequence_edges(pairs, reset_to_zero):
+
+    """
+    desc:
+        Returns the edges of a marker sequence for PulseScheduler.schedule:
+        the offset (ms) of each marker value from the start of the sequence,
+        and the end of the sequence, at which the marker value is reset to 0
+        or (None) which the sequence is held until.
+    """
+
+    offset = 0
+    edges = []
+    for value, duration in pairs:
+        edges.append((offset, value))
+        offset += duration
+    edges.append((offset, 0 if reset_to_zero else None))
+    return edges
+
+
+class markers_os3_sequence(item):
+    """
+    This class handles the basic functionality of the item.
+    """
+
+    description = 'Sends a sequence of markers to Leiden Univ marker device - Markers plugin for OpenSesame 3'
+
+    def reset(self):
+
+        """
+        desc:
+            Resets plug-in to initial values.
+        """
+        self.var.marker_device_tag = u'marker_device_1'
+        self.var.marker_sequence = u'1:10; 2:10'
+        self.var.marker_reset_to_zero = 'yes'
+
+        # Result of prepare
+        self._timeline = []
+
+    def get_tag(self):
+        return self.var.marker_device_tag
+
+    def get_sequence(self):
+        return self.var.marker_sequence
+
+    def get_reset_to_zero(self):
+        return self.var.marker_reset_to_zero == u'yes'
+
+    def is_already_init(self):
+        try:
+            return hasattr(self.experiment, f"markers_{self.get_tag()}")
+        except:
+            return False
+
+    def get_marker_manager(self):
+        if self.is_already_init():
+            return getattr(self.experiment, f"markers_{self.get_tag()}")
+        else:
+            return None
+
+    def get_scheduler(self):
+
+        """
+        desc:
+            Returns the pulse scheduler of the device (used for all marker
+            writes of the init item).
+        """
+
+        return getattr(self.experiment, f"markers_scheduler_{self.get_tag()}")
+
+    def prepare(self):
+
+        """
+        desc:
+            Prepare phase.
+        """
+
+        # Check input of plugin:
+        device_tag = self.get_tag()
+        if not isinstance(device_tag, str) or TAG_PATTERN.match(device_tag) is None:
+            # Raise error, tag can only contain: letters, numbers, underscores and dashes and should start with letter.
+            raise osexception("Device tag can only contain letters, numbers, underscores and dashes "
+                              "and should start with a letter.")
+
+        # Precompute the timeline: offset (ms) of each pulse edge from the start of the sequence
+        self._timeline = sequence_edges(parse_sequence(self.get_sequence()), self.get_reset_to_zero())
+
+        # Call the parent constructor.
+        item.prepare(self)
+
+    def run(self):
+
+        """
+        desc:
+            Run phase.
+        """
+
+        # Check if the marker device is initialized
+        if not self.is_already_init():
+            raise osexception("You must have a markers_os3_init item before sending markers."
+                              " Make sure the Device tags match.")
+
+        # The edges are written by the scheduler thread of the device, each
+        # relative to the start of the sequence, so the time needed to write a
+        # marker does not add up over the sequence. The item returns
+        # immediately, markers sent while the sequence runs wait for its end.
+        self.set_item_onset()
+        try:
+            self.get_scheduler().schedule(self._timeline)
+        except:
+            raise osexception(f"Error sending marker sequence: {sys.exc_info()[1]}")
+
+
+class qtmarkers_os3_sequence(markers_os3_sequence, qtautoplugin):
+    """
+    This class handles the GUI aspect of the plug-in. By using qtautoplugin, we
+    usually need to do hardly anything, because the GUI is defined in info.json.
+    """
+
+    def __init__(self, name, experiment, script=None):
+
+        """
+        Constructor.
+
+        Arguments:
+        name		--	The name of the plug-in.
+        experiment	--	The experiment object.
+
+        Keyword arguments:
+        script		--	A definition script. (default=None)
+        """
+
+        # Call the parent constructors.
+        markers_os3_sequence.__init__(self, name, experiment, script)
+        qtautoplugin.__init__(self, __file__)
+
+    def init_edit_widget(self):
+
+        """
+        Constructs the GUI controls. Usually, you can omit this function
+        altogether, but if you want to implement more advanced functionality,
+        such as controls that are grayed out under certain conditions, you need
+        to implement this here.
+        """
+
+        # First, call the parent constructor, which constructs the GUI controls
+        # based on info.json.
+        qtautoplugin.init_edit_widget(self)
+        self.custom_interactions()
+
+    def apply_edit_changes(self):
+
+        """
+        desc:
+            Applies the controls.
+        """
+
+        if not qtautoplugin.apply_edit_changes(self) or self.lock:
+            return False
+        self.custom_interactions()
+
+    def edit_widget(self):
+
+        """
+        Refreshes the controls.
+
+        Returns:
+        The QWidget containing the controls
+        """
+
+        if self.lock:
+            return
+        self.lock = True
+        w = qtautoplugin.edit_widget(self)
+        self.custom_interactions()
+        self.lock = False
+        return w
+
+    def custom_interactions(self):
+
+        """
+        desc:
+            Activates the relevant controls for each setting.
+        """
+        
\ No newline at end of file
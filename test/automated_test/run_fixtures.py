@@ -0,0 +1,179 @@
+# %% Imports
+"""
+Runs the .osexp test experiments in parallel, each in its own worker process
+(headless, with its own log file in a temporary folder), and checks the
+expected errors and the marker tables of each experiment.
+
+Usage:
+
+    python run_fixtures.py [--jobs N] [--stress] [experiment ...]
+
+With --stress, the stress experiments (e.g. 100k markers) are also run. The
+wall time of each experiment is reported, so slow experiments (throughput
+regressions in the send path) stand out.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import traceback
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_plugin import experiment_path, crashing_experiments, normal_experiments
+
+# Stress experiments, with the minimum number of marker writes (markers and
+# marker errors) and the maximum wall time (s)
+stress_experiments = {
+    "stress_testmarkers_os3_100k_markers.osexp": (100000, 300)
+}
+
+# Experiments that are run one after another in the same worker process,
+# e.g. to use the connection kept open by the previous run
+same_process_experiments = ["pass_testmarkers_os3_keep_connection.osexp"]
+
+_app = None
+
+
+def init_worker():
+    """
+    Worker process initialization: no windows are opened.
+    """
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+
+def marker_tables(var):
+    """
+    Returns the number of markers and marker errors of each marker device,
+    from the marker tables set by markers_os3_init at the end of the experiment.
+    """
+
+    tables = {}
+    for tag in getattr(var, 'markers_tags', []):
+        marker_df = getattr(var, f"markers_marker_table_{tag}", None)
+        error_df = getattr(var, f"markers_error_table_{tag}", None)
+        tables[tag] = (None if marker_df is None else len(marker_df),
+                       None if error_df is None else len(error_df))
+    return tables
+
+
+def run_experiments(experiment_files):
+    """
+    Runs experiments one after another in this worker process, each with its
+    own log file. Returns a result dict per experiment (only picklable values).
+    """
+
+    global _app
+    from libopensesame.experiment import experiment
+    from qtpy.QtWidgets import QApplication
+    if _app is None:
+        _app = QApplication.instance() or QApplication([])
+
+    results = []
+    for experiment_file in experiment_files:
+        result = {'experiment': experiment_file, 'error_type': None, 'error': None, 'tables': {}}
+        with tempfile.TemporaryDirectory() as log_folder:
+            t0 = time.perf_counter()
+            try:
+                e = experiment(
+                    logfile = os.path.join(log_folder, 'subject-0.csv'),
+                    experiment_path = experiment_path,
+                    string = os.path.join(experiment_path, experiment_file)
+                )
+                e.var.canvas_backend = r'legacy'
+                try:
+                    e.run()
+                finally:
+                    result['tables'] = marker_tables(e.var)
+            except Exception as error:
+                result['error_type'] = type(error).__name__
+                result['error'] = f"{error}\n{traceback.format_exc()}"
+            result['wall_time'] = time.perf_counter() - t0
+        results.append(result)
+    return results
+
+
+def check_result(result):
+    """
+    Returns a list of problems with the result of an experiment (empty when
+    the experiment ran as expected).
+    """
+
+    experiment_file = result['experiment']
+    problems = []
+    if experiment_file in crashing_experiments:
+        if result['error_type'] != 'osexception':
+            problems.append(f"expected osexception, got {result['error_type']}")
+        elif re.search(crashing_experiments[experiment_file], result['error']) is None:
+            problems.append(f"unexpected error message: {result['error'].splitlines()[0]}")
+        return problems
+
+    if result['error_type'] is not None:
+        return [f"unexpected {result['error_type']}: {result['error']}"]
+    for tag, (n_markers, n_errors) in result['tables'].items():
+        if n_markers is None:
+            problems.append(f"no marker table for {tag}")
+        elif experiment_file in stress_experiments:
+            min_writes, max_wall_time = stress_experiments[experiment_file]
+            if n_markers + (n_errors or 0) < min_writes:
+                problems.append(f"{tag}: {n_markers + (n_errors or 0)} marker writes, expected {min_writes}")
+            if result['wall_time'] > max_wall_time:
+                problems.append(f"took {result['wall_time']:.1f} s, expected at most {max_wall_time} s")
+        elif n_errors:
+            problems.append(f"{tag}: {n_errors} marker errors")
+    return problems
+
+
+def make_jobs(experiment_files):
+    """
+    Groups the experiments into jobs, one worker process per job.
+    """
+
+    jobs = []
+    same_process = []
+    for experiment_file in experiment_files:
+        if experiment_file in same_process_experiments:
+            same_process.append(experiment_file)
+        else:
+            jobs.append((experiment_file,))
+    if same_process:
+        jobs.append(tuple(same_process))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the marker test experiments in parallel.")
+    parser.add_argument('experiments', nargs='*', help="Experiment files (default: all test experiments)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument('--stress', action='store_true', help="Also run the stress experiments")
+    args = parser.parse_args(argv)
+
+    experiment_files = args.experiments or (normal_experiments + list(crashing_experiments)
+                                            + (list(stress_experiments) if args.stress else []))
+
+    # A new process for every job (spawn: Qt and pygame do not survive a fork)
+    t0 = time.perf_counter()
+    failed = 0
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.jobs, initializer=init_worker, maxtasksperchild=1) as pool:
+        for results in pool.imap_unordered(run_experiments, make_jobs(experiment_files)):
+            for result in results:
+                problems = check_result(result)
+                failed += bool(problems)
+                print(f"{'FAIL' if problems else 'ok  '} {result['wall_time']:7.2f} s  {result['experiment']}")
+                for problem in problems:
+                    print(f"       {problem}")
+
+    print(f"{len(experiment_files) - failed} of {len(experiment_files)} experiments ok "
+          f"({time.perf_counter() - t0:.1f} s)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
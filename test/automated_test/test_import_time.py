@@ -0,0 +1,56 @@
+# %% Imports
+import unittest
+import os
+import sys
+import subprocess
+
+plugin_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_plugins')
+extension_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_extensions')
+
+plugin_modules = [
+    (plugin_path, "markers_os3_init"),
+    (plugin_path, "markers_os3_send"),
+    (plugin_path, "markers_os3_sequence"),
+    (extension_path, "markers_os3_extension")
+]
+
+# Modules that should only be imported when markers are actually used
+deferred_modules = ["pandas", "numpy", "python_markers"]
+
+# Maximum time (us) to execute a plugin module itself, excluding its imports
+max_self_time_us = 20000
+
+
+def import_times(path, module):
+    """
+    Imports module in a new interpreter with -X importtime, returns a dict with
+    the self and cumulative import time (us) per imported module.
+    """
+
+    code = f"import sys; sys.path.insert(0, {os.path.abspath(os.path.join(path, module))!r}); import {module}"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+class importTime(unittest.TestCase):
+
+    def test_importTime(self):
+        for path, module in plugin_modules:
+            print(f"Testing import of {module}")
+            times = import_times(path, module)
+            self_us, cumulative_us = times[module]
+            print(f"{module}: {self_us} us (self), {cumulative_us} us (cumulative)")
+
+            for deferred_module in deferred_modules:
+                self.assertNotIn(deferred_module, times, f"{module} imports {deferred_module}")
+            self.assertLess(self_us, max_self_time_us)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# %% Imports
+import unittest
+import os
+import sys
+import tempfile
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), r'../..'))
+from markers_analysis import find_marker_files, load_marker_files
+from markers_analysis.marker_files import COLUMNS
+
+
+def save_markers(folder, subject, tag, values):
+    """
+    Saves a binary marker file as saved by markers_os3_init with Binary marker file set to npy.
+    """
+
+    records = numpy.zeros(len(values), dtype=COLUMNS)
+    records['time_ms'] = numpy.arange(len(values)) * 100.
+    records['value'] = values
+    path = os.path.join(folder, f'subject-{subject}_{tag}_marker_data.npy')
+    numpy.save(path, records)
+    return path
+
+
+class markerFiles(unittest.TestCase):
+
+    def test_loadMarkerFiles(self):
+        with tempfile.TemporaryDirectory() as folder:
+            save_markers(folder, 1, 'eeg', [255, 0, 1, 0])
+            save_markers(folder, 2, 'eeg', [255, 0, 2, 0, 3])
+            save_markers(folder, 2, 'eye_tracker', [])
+            self.assertEqual(len(find_marker_files(folder)), 3)
+
+            markers = load_marker_files(folder)
+            self.assertEqual(len(markers), 9)
+            self.assertEqual(markers.subject.tolist(), [1] * 4 + [2] * 5)
+            self.assertEqual(markers.value.tolist(), [255, 0, 1, 0, 255, 0, 2, 0, 3])
+            self.assertEqual(set(markers.tag), {'eeg'})
+
+            markers = load_marker_files(find_marker_files(folder), as_dataframe=False)
+            self.assertEqual(markers['value'].dtype, numpy.int16)
+
+    def test_loadNoMarkerFiles(self):
+        self.assertEqual(len(load_marker_files([])), 0)
+
+if __name__ == '__main__':
+    unittest.main()
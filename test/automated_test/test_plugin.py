@@ -2,28 +2,42 @@
 import unittest
 import os
 from libopensesame.experiment import experiment
+from libopensesame.exceptions import osexception
 from qtpy.QtWidgets import QApplication
 
 logfile_path = os.path.join(os.path.dirname(__file__), r'./data/tmp.csv')
 experiment_path = os.path.join(os.path.dirname(__file__), r'data')
 
-crashing_experiments = [
-    "fail_testmarkers_os3_init_twice.osexp",
-    "fail_testmarkers_os3_invalid_device_address.osexp",
-    "fail_testmarkers_os3_invalid_device_tag.osexp",
-    "fail_testmarkers_os3_invalid_marker_value.osexp",
-    "fail_testmarkers_os3_invalid_object_dur.osexp",
-    "fail_testmarkers_os3_marker_duration_error.osexp",
-    "fail_testmarkers_os3_no_init_obj.osexp",
-    "fail_testmarkers_os3_no_matching_device_tags.osexp",
-    "fail_testmarkers_os3_same_value_twice.osexp",
-    "fail_testmarkers_os3_no_device_attached.osexp"
-]
+# Crashing experiments, with the expected error message (regular expression)
+crashing_experiments = {
+    "fail_testmarkers_os3_init_twice.osexp": r"Marker device already initialized",
+    "fail_testmarkers_os3_invalid_device_address.osexp": r"Incorrect marker device address",
+    "fail_testmarkers_os3_invalid_device_tag.osexp": r"Incorrect device tag",
+    "fail_testmarkers_os3_invalid_marker_value.osexp": r"[Mm]arker (with )?value '?b",
+    "fail_testmarkers_os3_invalid_object_dur.osexp": r"Object duration should be numeric",
+    "fail_testmarkers_os3_marker_duration_error.osexp": r"Error sending marker with value 0",
+    "fail_testmarkers_os3_no_init_obj.osexp": r"You must have a markers_os3_init item",
+    "fail_testmarkers_os3_no_matching_device_tags.osexp": r"You must have a markers_os3_init item",
+    "fail_testmarkers_os3_same_value_twice.osexp": r"Error sending marker with value 255",
+    "fail_testmarkers_os3_no_device_attached.osexp": r"Marker device init error"
+}
 
 normal_experiments = [
     "pass_testmarkers_os3_basic.osexp",
     "pass_testmarkers_os3_multiple_devices.osexp",
-    "pass_testmarkers_os3_no_marker_objects.osexp"
+    "pass_testmarkers_os3_no_marker_objects.osexp",
+    "pass_testmarkers_os3_pulse_mode.osexp",
+    "pass_testmarkers_os3_stream_log.osexp",
+    "pass_testmarkers_os3_sequence.osexp",
+    "pass_testmarkers_os3_broadcast.osexp",
+    "pass_testmarkers_os3_binary_file.osexp",
+    "pass_testmarkers_os3_async_send.osexp",
+    "pass_testmarkers_os3_flip_locked.osexp",
+    "pass_testmarkers_os3_queued_writes.osexp",
+    "pass_testmarkers_os3_loop_references.osexp",
+    # Run twice, the second run uses the connection kept open by the first run
+    "pass_testmarkers_os3_keep_connection.osexp",
+    "pass_testmarkers_os3_keep_connection.osexp"
 ]
 
 class runExperiments(unittest.TestCase):
@@ -44,7 +58,7 @@ class runExperiments(unittest.TestCase):
             
     def test_runTestsCrash(self):
         app = QApplication([])
-        for experiment_file in crashing_experiments:
+        for experiment_file, message in crashing_experiments.items():
             print(f"Testing {experiment_file}")
             e = experiment(
                 logfile = logfile_path,
@@ -53,7 +67,7 @@ class runExperiments(unittest.TestCase):
             )
             e.var.canvas_backend = r'legacy'
             
-            with self.assertRaises(Exception) as exception:  # TODO: Exception types!
+            with self.assertRaisesRegex(osexception, message):
                 e.run()
             print(e)
 
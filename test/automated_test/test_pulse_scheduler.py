@@ -0,0 +1,136 @@
+# %% Imports
+import unittest
+import os
+import sys
+import time
+import random
+
+plugin_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_plugins/markers_os3_init')
+sys.path.insert(0, os.path.abspath(plugin_path))
+
+import markers_os3_init as init_module
+
+
+class SlowMarkerManager:
+    """
+    Marker manager with a write latency of up to max_latency (s), that
+    records marker duration errors as the MarkerManager of python_markers.
+    """
+
+    def __init__(self, max_latency=0.002):
+        self.max_latency = max_latency
+        self.writes = []
+        self.errors = []
+
+    def set_value(self, value):
+        now = time.perf_counter()
+        if self.writes and self.writes[-1][1] != 0 and now - self.writes[-1][0] < 0.010:
+            self.errors.append((now, value))
+        self.writes.append((now, value))
+        time.sleep(random.uniform(0, self.max_latency))
+
+
+def clock_ms():
+    return time.perf_counter() * 1000
+
+
+class queuedWrites(unittest.TestCase):
+
+    def test_noDurationErrors(self):
+        random.seed(0)
+        marker_manager = SlowMarkerManager()
+        scheduler = init_module.PulseScheduler(marker_manager, clock_ms, min_duration=0.010)
+        scheduler.start()
+        for value in range(1, 41):
+            scheduler.set_value(value)
+            if value % 10 == 0:
+                scheduler.pulse(value + 100, 5)
+        scheduler.drain()
+
+        self.assertEqual(len(scheduler.error_table()), 0)
+        self.assertEqual(marker_manager.errors, [])
+        self.assertGreater(len(scheduler.deferrals), 0)
+        marker_table = scheduler.marker_table()
+        self.assertGreaterEqual(marker_table['duration_ms'].dropna().min(), 10)
+        # The write latency includes the latency of the marker manager
+        self.assertTrue((marker_table['write_latency_us'] >= 0).all())
+        self.assertGreater(marker_table['write_latency_us'].max(), 100)
+
+    def test_asyncWriteTimes(self):
+        scheduler = init_module.PulseScheduler(SlowMarkerManager(max_latency=0), clock_ms, min_duration=0.010)
+        scheduler.start()
+        sender = init_module.AsyncMarkerSender(scheduler)
+        written, deferred, skipped = sender.send(1), sender.send(2), sender.send(2)
+        time_ms = [written.result(timeout=1), deferred.result(timeout=1), skipped.result(timeout=1)]
+        sender.close()
+        scheduler.drain()
+
+        # The deferred marker resolves with the time at which it was written,
+        # the skipped marker with the time of the marker with the same value
+        self.assertEqual(scheduler.marker_table()['time_ms'].tolist(), time_ms[:2])
+        self.assertGreaterEqual(time_ms[1] - time_ms[0], 10)
+        self.assertEqual(time_ms[2], time_ms[1])
+        self.assertEqual([action for time_ms, value, delay_ms, action in scheduler.deferrals],
+                         ['deferred', 'coalesced'])
+
+
+class markerTable(unittest.TestCase):
+
+    def test_broadcastSkew(self):
+        scheduler = init_module.PulseScheduler(SlowMarkerManager(max_latency=0), clock_ms)
+        scheduler.start()
+        scheduler.set_value(1)
+        # Sent to multiple devices at once, with the time of the broadcast
+        time_ms = clock_ms()
+        scheduler.set_value(2, time_ms=time_ms)
+        scheduler.log_broadcast(time_ms, 2, 0.25)
+        scheduler.set_value(0)
+        scheduler.drain()
+
+        marker_table = scheduler.marker_table()
+        self.assertEqual(marker_table['value'].tolist(), [1, 2, 0])
+        self.assertEqual(marker_table['skew_ms'].isna().tolist(), [True, False, True])
+        self.assertEqual(marker_table['skew_ms'][1], 0.25)
+
+
+class markerSequence(unittest.TestCase):
+
+    def test_scheduleInBackground(self):
+        marker_manager = SlowMarkerManager(max_latency=0)
+        scheduler = init_module.PulseScheduler(marker_manager, clock_ms)
+        scheduler.start()
+        start = time.perf_counter()
+        scheduler.schedule([(0, 1), (20, 2), (40, 0)])
+        # The first marker value is written right away, the rest by the scheduler thread
+        self.assertLess(time.perf_counter() - start, 0.010)
+        self.assertEqual([value for write_time, value in marker_manager.writes], [1])
+
+        # A marker value set during the sequence waits for its end
+        scheduler.set_value(3)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.040)
+        scheduler.drain()
+        self.assertEqual([value for write_time, value in marker_manager.writes], [1, 2, 0, 3])
+        self.assertGreaterEqual(marker_manager.writes[1][0] - start, 0.020)
+
+
+class switchInterval(unittest.TestCase):
+
+    def test_lowerNearDeadline(self):
+        original = sys.getswitchinterval()
+        scheduler = init_module.PulseScheduler(SlowMarkerManager(max_latency=0), clock_ms)
+        scheduler.start()
+
+        # A deadline far ahead keeps the original switch interval
+        scheduler.pulse(1, 300)
+        time.sleep(0.05)
+        self.assertEqual(sys.getswitchinterval(), original)
+
+        # A deadline within the window is lowered right away
+        scheduler.pulse(2, 2)
+        self.assertLess(sys.getswitchinterval(), original)
+        scheduler.drain()
+        self.assertEqual(sys.getswitchinterval(), original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# %% Imports
+import unittest
+import os
+import sys
+from types import SimpleNamespace
+
+plugin_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_plugins/markers_os3_send')
+sys.path.insert(0, os.path.abspath(plugin_path))
+
+from libopensesame.exceptions import osexception
+import markers_os3_send as send_module
+
+
+class VarStore(dict):
+    """
+    Variable store with the get and attribute access of the OpenSesame var
+    store, without evaluation of variable references.
+    """
+
+    def get(self, name, default=None, _eval=True):
+        return dict.get(self, name, default)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class LoopTable(list):
+    """
+    Loop table as the live_dm of a loop item: rows with column access.
+    """
+
+    def __init__(self, rows):
+        list.__init__(self, rows)
+        self.column_names = list(rows[0])
+
+
+class CountingSend(send_module.markers_os3_send):
+    """
+    markers_os3_send item in a loop with a marker_value column, that counts
+    the evaluations of the marker value.
+    """
+
+    def __init__(self, values, crash_on_marker_errors=False):
+        self.name = 'send_marker'
+        self.var = VarStore()
+        self.reset()
+        # The item's own marker_value refers to the loop variable of the same name
+        self.var.marker_value = '[marker_value]'
+        rows = [{'marker_value': value} for value in values]
+        self.experiment = SimpleNamespace(var=VarStore(), items={}, cleanup_functions=[])
+        self.experiment.markers_scheduler_marker_device_1 = SimpleNamespace(
+            crash_on_marker_errors=crash_on_marker_errors, min_duration=None)
+        self._loop = SimpleNamespace(name='block_loop', live_dm=LoopTable(rows), live_row=0)
+        self._checked_tags = ['marker_device_1']
+        self._reset_to_zero = False
+        self._pulse_mode = False
+        self.get_value_calls = 0
+
+    def get_value(self):
+        self.get_value_calls += 1
+        return self.experiment.var.marker_value
+
+    def run_row(self, row):
+        # The loop sets the variables of the row in the experiment var store
+        self._loop.live_row = row
+        self.experiment.var.update(self._loop.live_dm[row])
+        return self.get_run_value()
+
+
+class loopValues(unittest.TestCase):
+
+    def test_precomputedValues(self):
+        values = [1, 2, 3, 4]
+        item = CountingSend(values)
+        item.prepare_loop_values()
+        self.assertEqual([item.run_row(row) for row in range(len(values))], values)
+        self.assertEqual(item.get_value_calls, 0)
+
+    def test_changedLoopVariable(self):
+        item = CountingSend([1, 2, 3, 4])
+        item.prepare_loop_values()
+        item._loop.live_row = 2
+        item.experiment.var.update(item._loop.live_dm[2])
+        # Changed by an inline_script after the loop set it
+        item.experiment.var.marker_value = 8
+        self.assertEqual(item.get_run_value(), 8)
+        self.assertEqual(item.get_value_calls, 1)
+
+    def test_sameValueTwice(self):
+        item = CountingSend([1, 2, 2, 4])
+        item.prepare_loop_values()
+        self.assertEqual(item.run_row(2), 2)
+
+        item = CountingSend([1, 2, 2, 4], crash_on_marker_errors=True)
+        with self.assertRaises(osexception):
+            item.prepare_loop_values()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# %% Imports
+import unittest
+import os
+import sys
+import tempfile
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), r'../..'))
+from markers_analysis import detect_trigger_edges, read_marker_table, read_trigger_channel, verify_markers
+
+
+def record_markers(time_ms, values, sample_rate, n_samples, offset_ms=0., drift=0., duration_ms=10.):
+    """
+    Trigger channel as recorded by an amplifier, with the markers at the
+    given times of the marker clock (with offset and clock drift).
+    """
+
+    trigger = numpy.zeros(n_samples, dtype=numpy.int16)
+    samples = numpy.round(((1 + drift) * numpy.asarray(time_ms) + offset_ms) * sample_rate / 1000).astype(int)
+    for sample, value in zip(samples, values):
+        if 0 <= sample < n_samples:
+            trigger[sample:sample + int(duration_ms * sample_rate / 1000)] = value
+    return trigger
+
+
+class verifyMarkers(unittest.TestCase):
+
+    def test_detectEdges(self):
+        trigger = numpy.array([0, 0, 3, 3, 3, 0, 0, 7, 5, 5, 5, 0, 0, 1, 1], dtype=numpy.int16)
+        edges = detect_trigger_edges(trigger, 1000, chunk_size=4)
+        self.assertEqual(edges['sample'].tolist(), [2, 7, 8, 13])
+        self.assertEqual(edges['value'].tolist(), [3, 7, 5, 1])
+
+        # Value 7 lasts one sample only
+        edges = detect_trigger_edges(trigger, 1000, min_samples=2)
+        self.assertEqual(edges['value'].tolist(), [3, 5, 1])
+        self.assertEqual(edges['duration_ms'].tolist(), [3., 3., 2.])
+
+    def test_verifyMarkers(self):
+        rng = numpy.random.default_rng(0)
+        time_ms = numpy.cumsum(rng.uniform(100, 300, 2000))
+        values = rng.integers(1, 256, 2000)
+        recorded = values.copy()
+        recorded[100] = recorded[100] % 255 + 1
+        recorded[200] = 0
+        sample_rate = 2000
+        trigger = record_markers(time_ms, recorded, sample_rate, int(time_ms[-1] * 2) - 4000,
+                                 offset_ms=-1000, drift=50e-6)
+        trigger[1000:1020] = 99
+
+        # Markers sent with reset to zero
+        markers = {'time_ms': numpy.repeat(time_ms, 2) + numpy.tile([0, 10], 2000),
+                   'value': numpy.ravel(numpy.column_stack([values, numpy.zeros(2000, int)]))}
+        result = verify_markers(markers, trigger, sample_rate)
+        summary = result['summary']
+        status = result['markers'].status
+        self.assertEqual(status[100], 'wrong_value')
+        self.assertEqual(status[200], 'missing')
+        self.assertEqual(summary['extra'], 1)
+        self.assertEqual(result['extra'].value.tolist(), [99])
+        # The first markers were sent before the start of the recording, the last after the end
+        self.assertEqual(status[:5].tolist(), ['not_recorded'] * 5)
+        self.assertEqual(status.iloc[-1], 'not_recorded')
+        self.assertEqual(summary['ok'] + summary['not_recorded'], 1998)
+        self.assertAlmostEqual(summary['drift_ppm'], 50, delta=1)
+        self.assertLess(summary['max_abs_latency_ms'], 1)
+
+    def test_readMarkerLog(self):
+        # Streaming marker log: only the marker rows, not the errors and deferrals
+        log = ("type\ttime_ms\tvalue\tmessage\twrite_latency_us\n"
+               "marker\t100.0\t1\t\t50.0\n"
+               "error\t105.0\t1\tThe same marker value is sent twice in a row\t\n"
+               "deferred\t106.0\t2\tdelay_ms=4.000\t\n"
+               "marker\t110.0\t2\t\t48.0\n"
+               "marker\t120.0\t0\t\t47.0\n")
+        # Marker summary file of the marker log: summary, latency and error table
+        summary = ("value\toccurrence\n1\t1\n\np50_us\tp95_us\n50.0\t55.0\n\n"
+                   "time_ms\tvalue\tmessage\n105.0\t1\tThe same marker value is sent twice in a row\n")
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'subject-1_eeg_marker_log.tsv')
+            with open(path, 'w') as f:
+                f.write(log)
+            markers = read_marker_table(path)
+            self.assertEqual(markers['time_ms'].tolist(), [100., 110., 120.])
+            self.assertEqual(markers['value'].tolist(), [1, 2, 0])
+
+            path = os.path.join(folder, 'subject-1_eeg_marker_summary.tsv')
+            with open(path, 'w') as f:
+                f.write(summary)
+            with self.assertRaises(ValueError):
+                read_marker_table(path)
+
+    def test_readMarkerFileFormats(self):
+        # Format 2: info row, summary, marker and error table
+        format_2 = ("format_version\tDevice tag\tSubject\n2\teeg\t1\n\n"
+                    "value\toccurrence\n1\t1\n\n"
+                    "time_ms\tvalue\tduration_ms\n100.0\t1\t10.0\n110.0\t0\t\n\n"
+                    "time_ms\tvalue\tmessage\n")
+        # Format 1 (save_marker_table of python_markers): times in s
+        format_1 = ("Device tag\tSubject\neeg\t1\n\n"
+                    "value\toccurrence\n1\t1\n\n"
+                    "value\tstart_time_s\tduration_s\n1\t0.1\t0.01\n0\t0.11\t\n")
+        with tempfile.TemporaryDirectory() as folder:
+            for version, content in [(2, format_2), (1, format_1)]:
+                path = os.path.join(folder, f'format_{version}_marker_table.tsv')
+                with open(path, 'w') as f:
+                    f.write(content)
+                markers = read_marker_table(path)
+                numpy.testing.assert_allclose(markers['time_ms'], [100., 110.])
+                self.assertEqual(markers['value'].tolist(), [1, 0])
+
+    def test_readTriggerChannel(self):
+        data = numpy.arange(12, dtype='<i4').reshape(4, 3)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'recording.raw')
+            data.tofile(path)
+            trigger = read_trigger_channel(path, dtype='<i4', n_channels=3, channel=2)
+            self.assertEqual(trigger.tolist(), [2, 5, 8, 11])
+            del trigger
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# %% Imports
+import os
+import sys
+import time
+import tempfile
+from types import SimpleNamespace
+from serial.tools import list_ports
+
+plugin_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_plugins/markers_os3_init')
+sys.path.insert(0, os.path.abspath(plugin_path))
+
+# Use a temporary device cache, do not touch the cache of the user
+os.environ['APPDATA'] = tempfile.mkdtemp()
+
+import markers_os3_init as init_module
+
+n_ports = 20
+probe_time = 0.1  # Time (s) to probe a port that does not respond
+device_port = 'COM17'
+n_repeats = 5
+
+
+class FakeSerialBackend:
+    """
+    Fake replacement for find_device: every probed port costs probe_time,
+    the marker device is only found on device_port.
+    """
+
+    def __init__(self):
+        self.ports = [f'COM{i}' for i in range(1, n_ports + 1)]
+
+    def comports(self):
+        return [SimpleNamespace(device=port) for port in self.ports]
+
+    def find_device(self, device_type='', serial_no='', com_port='', fallback_to_fake=False):
+        ports = [com_port] if com_port else self.ports
+        for port in ports:
+            time.sleep(probe_time)
+            if port == device_port:
+                return {'device': {'Device': 'UsbParMarker', 'Serialno': 'FAKE0001'},
+                        'com_port': port}
+        raise Exception('No marker device found.')
+
+
+class bench_init(init_module.markers_os3_init):
+
+    def __init__(self):
+        self.var = SimpleNamespace()
+        self.experiment = SimpleNamespace(var=SimpleNamespace())
+        self.reset()
+
+
+def time_init(device, cache_mode):
+    plugin = bench_init()
+    plugin.var.marker_device = device
+    plugin.var.marker_device_cache = cache_mode
+    t0 = time.perf_counter()
+    info = plugin.resolve_com_port()
+    assert info['com_port'] == device_port
+    return time.perf_counter() - t0
+
+
+def time_stale_cache(device):
+    """
+    Time to resolve the device when the cached port is wrong (e.g. the device
+    was plugged into another USB port): the cached port and all ports are
+    probed, after which the cache holds the new port again.
+    """
+
+    cache_key = init_module.device_cache_key('' if device == 'ANY' else device, '')
+    times = []
+    for _ in range(n_repeats):
+        init_module.write_device_cache({cache_key: {'com_port': 'COM3'}})
+        times.append(time_init(device, 'use'))
+        assert init_module.read_device_cache()[cache_key]['com_port'] == device_port
+    return times
+
+
+if __name__ == '__main__':
+    # ANY device: the ports are probed by the device discovery of the plugin
+    backend = FakeSerialBackend()
+    init_module.marker_management().find_device = backend.find_device
+    list_ports.comports = backend.comports
+
+    # ANY device: all ports are probed concurrently, UsbParMarker: find_device
+    # probes the ports one by one
+    for device in ['ANY', 'UsbParMarker']:
+        init_module.clear_device_cache()
+        for cache_mode in ['off', 'refresh', 'use']:
+            times = [time_init(device, cache_mode) for _ in range(n_repeats)]
+            label = {'off': 'no cache', 'refresh': 'cold cache', 'use': 'warm cache'}[cache_mode]
+            print(f"{device:<12} {label:<12}: mean {1000 * sum(times) / n_repeats:8.1f} ms")
+        times = time_stale_cache(device)
+        print(f"{device:<12} {'stale cache':<12}: mean {1000 * sum(times) / n_repeats:8.1f} ms")
@@ -0,0 +1,61 @@
+# %% Imports
+import os
+import sys
+import time
+import numpy
+import pandas
+
+extension_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_extensions/markers_os3_extension')
+sys.path.insert(0, os.path.abspath(extension_path))
+
+from markers_os3_extension import add_table_to_md
+
+table_sizes = [1000, 10000, 100000]
+
+
+def add_table_to_md_iterrows(md, df, table_title):
+    """
+    Previous implementation (one string concatenation per cell), for comparison.
+    """
+
+    md += u'##' + table_title + u':##' + u'\n'
+    md += u'| ' + u' | '.join(df.columns) + u' | \n'
+    md += u'|' + u':---|' * len(df.columns) + u'\n'
+    md += u'| '
+    for index, row in df.iterrows():
+        for column in df:
+            cur_value = row[column]
+            if isinstance(cur_value, float):
+                cur_value = round(cur_value, 3)
+            md += str(cur_value) + u' | '
+        md += u'\n'
+    md += u'\n\n'
+    return md
+
+
+def gen_marker_df(n_rows):
+    rng = numpy.random.default_rng(0)
+    time_ms = numpy.cumsum(rng.uniform(10, 2000, n_rows))
+    return pandas.DataFrame({'time_ms': time_ms,
+                             'value': rng.integers(1, 256, n_rows),
+                             'duration_ms': numpy.append(numpy.diff(time_ms), numpy.nan),
+                             'write_latency_us': rng.uniform(20, 200, n_rows),
+                             'skew_ms': numpy.nan})
+
+
+def time_function(function, *args, **kwargs):
+    t0 = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+if __name__ == '__main__':
+    for n_rows in table_sizes:
+        df = gen_marker_df(n_rows)
+        t_full = time_function(add_table_to_md, '', df, 'Marker table')
+        t_capped = time_function(add_table_to_md, '', df, 'Marker table', max_rows=1000)
+        line = f"{n_rows:>7} rows: all rows {t_full:8.3f} s, first 1000 rows {t_capped:8.3f} s"
+        if n_rows <= 10000:
+            t_old = time_function(add_table_to_md_iterrows, '', df, 'Marker table')
+            line += f", iterrows {t_old:8.3f} s"
+        print(line)
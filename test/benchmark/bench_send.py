@@ -0,0 +1,44 @@
+# %% Imports
+import time
+import numpy
+
+from fake_marker_device import FakeMarkerDevice, open_marker_manager
+import markers_os3_init as init_module
+
+n_sends = 20000
+n_repeats = 5
+
+
+def clock_ms():
+    return time.perf_counter() * 1000
+
+
+def cpu_time_per_send():
+    """
+    CPU time (us) per marker sent through the pulse scheduler to the fake
+    device.
+    """
+
+    device = FakeMarkerDevice()
+    device.start()
+    marker_manager = open_marker_manager(device.port, clock_ms)
+    scheduler = init_module.PulseScheduler(marker_manager, clock_ms)
+    scheduler.start()
+    values = [value % 255 + 1 for value in range(n_sends)]
+
+    times = []
+    for _ in range(n_repeats):
+        t0 = time.process_time()
+        for value in values:
+            scheduler.set_value(value)
+        times.append((time.process_time() - t0) * 1e6 / n_sends)
+
+    scheduler.drain()
+    assert device.wait_for(n_sends * n_repeats)
+    marker_manager.close()
+    device.stop()
+    return float(numpy.median(times))
+
+
+if __name__ == '__main__':
+    print(f"CPU time per send: {cpu_time_per_send():.2f} us")
@@ -0,0 +1,98 @@
+# %% Imports
+import os
+import sys
+import time
+import tempfile
+import numpy
+import pandas
+
+from fake_marker_device import FakeMarkerDevice, marker_manager_name, open_marker_manager
+
+import markers_os3_init as init_module
+
+n_markers_list = [1000, 10000, 100000]
+
+
+def gen_markers(n_markers):
+    """
+    Markers as sent by markers_os3_send with Reset marker value to zero: a
+    value followed by 0.
+    """
+
+    rng = numpy.random.default_rng(0)
+    values = numpy.zeros(n_markers, dtype=numpy.int16)
+    values[::2] = rng.integers(1, 256, len(values[::2]))
+    times = numpy.cumsum(rng.uniform(5, 500, n_markers))
+    return times, values
+
+
+def send_markers(device, n_markers):
+    """
+    Sends the markers to the fake device through the pulse scheduler, as
+    markers_os3_send does, with the generated times as the marker times (of
+    the scheduler and of the marker manager).
+
+    Returns the marker manager and the scheduler.
+    """
+
+    clock = {'ms': 0.0}
+    marker_manager = open_marker_manager(device.port, lambda: clock['ms'])
+    scheduler = init_module.PulseScheduler(marker_manager, lambda: clock['ms'])
+    # The markers are sent faster than real time, their durations are those of
+    # the generated times
+    scheduler.min_marker_duration = 0
+    times, values = gen_markers(n_markers)
+    for time_ms, value in zip(times.tolist(), values.tolist()):
+        clock['ms'] = time_ms
+        scheduler.set_value(value, time_ms)
+    return marker_manager, scheduler
+
+
+def save_baseline(marker_manager, location):
+    """
+    Marker tables and marker file of the marker manager (python_markers), as
+    saved at cleanup before the plugin kept its own tables.
+    """
+
+    marker_df, summary_df, error_df = marker_manager.gen_marker_table()
+    marker_manager.save_marker_table(filename='baseline', location=location,
+                                     more_info={'Device tag': 'marker_device_1', 'Subject': 0})
+    return marker_df, summary_df, error_df
+
+
+def save_plugin(scheduler, location):
+    """
+    Marker tables and marker file as saved by markers_os3_init.cleanup.
+    """
+
+    summary_df = pandas.DataFrame(scheduler.summary.rows(), columns=init_module.SUMMARY_COLUMNS)
+    marker_df, error_df = scheduler.marker_table(), scheduler.error_table()
+    init_module.save_marker_file(os.path.join(location, 'plugin.tsv'),
+                                 {'Device tag': 'marker_device_1', 'Subject': 0, **scheduler.latency_summary()},
+                                 (summary_df, marker_df, error_df))
+    return marker_df, summary_df, error_df
+
+
+def time_function(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - t0) * 1000, result
+
+
+if __name__ == '__main__':
+    if marker_manager_name() != 'python_markers':
+        print("python_markers is not installed: the baseline (gen_marker_table and save_marker_table) is not timed")
+    for n_markers in n_markers_list:
+        device = FakeMarkerDevice()
+        device.start()
+        marker_manager, scheduler = send_markers(device, n_markers)
+        with tempfile.TemporaryDirectory() as location:
+            t_plugin, (marker_df, summary_df, _) = time_function(save_plugin, scheduler, location)
+            assert len(marker_df) == n_markers and summary_df.occurrence.sum() == n_markers // 2
+            result = f"{n_markers} markers: plugin tables and marker file {t_plugin:.1f} ms"
+            if marker_manager_name() == 'python_markers':
+                t_baseline, _ = time_function(save_baseline, marker_manager, location)
+                result += f", gen_marker_table and save_marker_table {t_baseline:.1f} ms"
+        print(result)
+        marker_manager.close()
+        device.stop()
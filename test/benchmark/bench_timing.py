@@ -0,0 +1,317 @@
+# %% Imports
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import collections
+import numpy
+
+from fake_marker_device import FakeMarkerDevice, open_marker_manager, marker_manager_name
+import markers_os3_init as init_module
+import markers_os3_sequence as sequence_module
+
+baseline_path = os.path.join(os.path.dirname(__file__), r'baselines', f'timing_{sys.platform}.json')
+experiment_path = os.path.join(os.path.dirname(__file__), r'..', r'automated_test', r'data')
+
+n_init = 20
+n_item_runs = 5
+n_throughput = 5000
+n_latency = 1000
+n_pulses = 100
+pulse_duration_ms = 10
+# Each benchmark is repeated, the median of each metric is compared and stored
+n_repeats = 5
+
+# A metric regresses when it is more than tolerance worse than the baseline,
+# and the difference is larger than the absolute slack (same unit as the metric)
+tolerance = 0.5
+slack = {'port_open_reset_ms': 5, 'item_init_ms': 50, 'item_send_p50_us': 200, 'item_send_p95_us': 500,
+          'throughput_markers_s': 0, 'send_latency_p50_us': 50, 'send_latency_p95_us': 100,
+         'send_latency_p99_us': 200, 'pulse_jitter_p50_us': 100, 'pulse_jitter_p95_us': 250,
+         'pulse_load_jitter_p50_us': 100, 'pulse_load_jitter_p95_us': 250,
+         'sequence_jitter_p50_us': 100, 'sequence_jitter_p95_us': 250}
+higher_is_better = ['throughput_markers_s']
+# Maxima depend too much on the load of the machine to compare
+not_compared = ['pulse_jitter_max_us', 'pulse_load_jitter_max_us', 'sequence_jitter_max_us']
+# Required maximum of a metric, independent of the baseline
+limits = {'pulse_jitter_p95_us': 1000, 'pulse_load_jitter_p95_us': 1000}
+
+
+def clock_ms():
+    return time.perf_counter() * 1000
+
+
+def start_device(marker_log=False):
+    device = FakeMarkerDevice()
+    device.start()
+    marker_manager = open_marker_manager(device.port, clock_ms)
+    log = None
+    if marker_log:
+        log = init_module.MarkerLogWriter(os.path.join(tempfile.mkdtemp(), 'marker_log.tsv'))
+        log.start()
+    scheduler = init_module.PulseScheduler(marker_manager, clock_ms, log)
+    scheduler.start()
+    return device, marker_manager, scheduler, log
+
+
+def stop_device(device, marker_manager, scheduler, log):
+    scheduler.drain()
+    if log is not None:
+        log.close()
+    marker_manager.close()
+    device.stop()
+
+
+def bench_port_open_reset():
+    """
+    Time (ms) from opening the port of the fake device until the reset marker
+    reached the device, with the pulse scheduler and marker log that
+    markers_os3_init.run starts (the item itself: see bench_items).
+    """
+
+    times = []
+    for _ in range(n_init):
+        device = FakeMarkerDevice()
+        device.start()
+        t0 = time.perf_counter()
+        marker_manager = open_marker_manager(device.port, clock_ms)
+        log = init_module.MarkerLogWriter(os.path.join(tempfile.mkdtemp(), 'marker_log.tsv'))
+        log.start()
+        scheduler = init_module.PulseScheduler(marker_manager, clock_ms, log)
+        scheduler.start()
+        scheduler.set_value(0)
+        device.wait_for(1)
+        times.append((device.arrivals[0][0] - t0) * 1000)
+        stop_device(device, marker_manager, scheduler, log)
+    return {'port_open_reset_ms': float(numpy.median(times))}
+
+
+def bench_throughput():
+    """
+    Markers per second through the pulse scheduler and streaming marker log.
+    """
+
+    device, marker_manager, scheduler, log = start_device(marker_log=True)
+    t0 = time.perf_counter()
+    for i in range(n_throughput):
+        scheduler.set_value(i % 255 + 1)
+    elapsed = time.perf_counter() - t0
+    if not device.wait_for(n_throughput):
+        raise Exception(f"Fake device received {len(device.arrivals)} of {n_throughput} markers")
+    stop_device(device, marker_manager, scheduler, log)
+    return {'throughput_markers_s': n_throughput / elapsed}
+
+
+def bench_send_latency():
+    """
+    Time (us) from calling set_value until the value arrived at the device.
+    """
+
+    device, marker_manager, scheduler, log = start_device()
+    latencies = []
+    for i in range(n_latency):
+        n_received = len(device.arrivals)
+        t0 = time.perf_counter()
+        scheduler.set_value(i % 255 + 1)
+        device.wait_for(n_received + 1)
+        latencies.append((device.arrivals[-1][0] - t0) * 1e6)
+    stop_device(device, marker_manager, scheduler, log)
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    return {'send_latency_p50_us': p50, 'send_latency_p95_us': p95, 'send_latency_p99_us': p99}
+
+
+def pulse_jitter(arrivals):
+    """
+    Deviation (us) of the duration of each pulse, until the next value that
+    arrived at the device (normally the reset, or the next pulse when the
+    reset came too late), from the requested duration.
+    """
+
+    times = numpy.array([arrival for arrival, value in arrivals])
+    values = numpy.array([value for arrival, value in arrivals])
+    onsets = numpy.flatnonzero(values[:-1] != 0)
+    return numpy.abs((times[onsets + 1] - times[onsets]) * 1e6 - pulse_duration_ms * 1000)
+
+
+def bench_pulse_jitter():
+    """
+    Deviation (us) of the pulse duration measured at the device from the
+    requested duration, for pulses reset by the pulse scheduler.
+    """
+
+    device, marker_manager, scheduler, log = start_device()
+    for i in range(n_pulses):
+        scheduler.pulse(i % 255 + 1, pulse_duration_ms)
+        time.sleep(2 * pulse_duration_ms / 1000)
+    device.wait_for(2 * n_pulses)
+    stop_device(device, marker_manager, scheduler, log)
+    jitter = pulse_jitter(device.arrivals)
+    p50, p95 = numpy.percentile(jitter, [50, 95])
+    return {'pulse_jitter_p50_us': p50, 'pulse_jitter_p95_us': p95, 'pulse_jitter_max_us': jitter.max()}
+
+
+def bench_pulse_jitter_load():
+    """
+    Deviation (us) of the pulse duration while the main thread runs Python
+    code (e.g. polling for a response), so the pulse scheduler thread has to
+    get the GIL from the main thread for the reset.
+    """
+
+    device, marker_manager, scheduler, log = start_device()
+    for i in range(n_pulses):
+        scheduler.pulse(i % 255 + 1, pulse_duration_ms)
+        end = time.perf_counter() + 2 * pulse_duration_ms / 1000
+        total = 0
+        while time.perf_counter() < end:
+            for j in range(1000):
+                total += j
+    device.wait_for(2 * n_pulses)
+    stop_device(device, marker_manager, scheduler, log)
+    jitter = pulse_jitter(device.arrivals)
+    p50, p95 = numpy.percentile(jitter, [50, 95])
+    return {'pulse_load_jitter_p50_us': p50, 'pulse_load_jitter_p95_us': p95, 'pulse_load_jitter_max_us': jitter.max()}
+
+
+def bench_sequence_jitter():
+    """
+    Deviation (us) of each pulse edge of a marker sequence, measured at the
+    device, from its planned offset.
+    """
+
+    device, marker_manager, scheduler, log = start_device()
+    sequence = '; '.join(f"{i % 255 + 1}:{pulse_duration_ms}" for i in range(n_pulses))
+    edges = sequence_module.sequence_edges(sequence_module.parse_sequence(sequence), True)
+    offsets = numpy.array([offset for offset, value in edges]) / 1000
+    # As markers_os3_sequence.run: the edges are written by the scheduler thread
+    scheduler.schedule(edges)
+    device.wait_for(len(edges))
+    stop_device(device, marker_manager, scheduler, log)
+    arrivals = numpy.array([arrival for arrival, value in device.arrivals[:len(edges)]])
+    jitter = numpy.abs(arrivals - arrivals[0] - offsets) * 1e6
+    p50, p95 = numpy.percentile(jitter, [50, 95])
+    return {'sequence_jitter_p50_us': p50, 'sequence_jitter_p95_us': p95, 'sequence_jitter_max_us': jitter.max()}
+
+
+def bench_items():
+    """
+    Times of the markers_os3_init and markers_os3_send items in dummy mode, as
+    run by OpenSesame (pass_testmarkers_os3_pulse_mode.osexp, headless):
+    prepare and run (ms) of the init item, including the flash, and run (us)
+    of each send item in pulse mode.
+    """
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from libopensesame.experiment import experiment
+    from qtpy.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+
+    def timed(item, phase, times):
+        function = getattr(item, phase)
+
+        def call(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                times[item.item_type, phase].append(time.perf_counter() - t0)
+
+        setattr(item, phase, call)
+
+    init_times = []
+    send_times = []
+    for _ in range(n_item_runs):
+        times = collections.defaultdict(list)
+        with tempfile.TemporaryDirectory() as log_folder:
+            e = experiment(logfile=os.path.join(log_folder, 'subject-0.csv'), experiment_path=experiment_path,
+                           string=os.path.join(experiment_path, 'pass_testmarkers_os3_pulse_mode.osexp'))
+            e.var.canvas_backend = r'legacy'
+            for item in e.items.values():
+                if item.item_type in ('markers_os3_init', 'markers_os3_send'):
+                    timed(item, 'prepare', times)
+                    timed(item, 'run', times)
+            e.run()
+        init_times.append(sum(times['markers_os3_init', 'prepare'] + times['markers_os3_init', 'run']) * 1000)
+        send_times += [t * 1e6 for t in times['markers_os3_send', 'run']]
+    p50, p95 = numpy.percentile(send_times, [50, 95])
+    return {'item_init_ms': float(numpy.median(init_times)), 'item_send_p50_us': p50, 'item_send_p95_us': p95}
+
+
+def run_benchmarks(benchmarks, repeats):
+    """
+    Runs each benchmark repeats times and returns the median of each metric.
+    """
+
+    runs = collections.defaultdict(list)
+    for _ in range(repeats):
+        for benchmark in benchmarks:
+            for metric, value in benchmark().items():
+                runs[metric].append(float(value))
+    return {metric: float(numpy.median(values)) for metric, values in runs.items()}
+
+
+def compare_to_baseline(results, baseline):
+    regressions = [f"{metric}: {results[metric]:.1f} (limit {limit})" for metric, limit in limits.items()
+                   if results.get(metric, 0) > limit]
+    for metric, value in results.items():
+        if metric not in baseline or metric in not_compared:
+            continue
+        reference = baseline[metric]
+        if metric in higher_is_better:
+            worse = value < reference * (1 - tolerance)
+        else:
+            worse = value > reference * (1 + tolerance) and value - reference > slack.get(metric, 0)
+        if worse:
+            regressions.append(f"{metric}: {value:.1f} (baseline {reference:.1f})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timing benchmarks of the markers plugin with a fake marker device.')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as new baseline.')
+    parser.add_argument('--no-items', action='store_true',
+                        help='Skip the item benchmarks (they need OpenSesame).')
+    parser.add_argument('--repeats', type=int, default=n_repeats,
+                        help=f'Number of runs of each benchmark, the median is used (default {n_repeats}).')
+    args = parser.parse_args()
+
+    benchmarks = [bench_port_open_reset, bench_throughput, bench_send_latency, bench_pulse_jitter,
+                  bench_pulse_jitter_load, bench_sequence_jitter]
+    if not args.no_items:
+        benchmarks.append(bench_items)
+    marker_manager = marker_manager_name()
+    print(f"Marker manager: {marker_manager}, median of {args.repeats} runs")
+    results = run_benchmarks(benchmarks, args.repeats)
+    for metric, value in results.items():
+        print(f"{metric:<24}: {value:12.1f}")
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump({'platform': platform.platform(), 'python': platform.python_version(),
+                       'marker_manager': marker_manager, 'repeats': args.repeats, **results}, f, indent=4)
+        print(f"Baseline saved in {baseline_path}")
+        sys.exit(0)
+
+    if not os.path.exists(baseline_path):
+        print(f"No baseline in {baseline_path}, run with --update-baseline on a reference machine.")
+        sys.exit(1)
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('marker_manager') != marker_manager:
+        print(f"The baseline was recorded with marker manager {baseline.get('marker_manager')}, "
+              f"not with {marker_manager}, run with --update-baseline.")
+        sys.exit(1)
+    missing = [metric for metric in results if metric not in baseline and metric not in not_compared]
+    if missing:
+        print("No baseline for " + ', '.join(missing) + ", run with --update-baseline.")
+        sys.exit(1)
+    regressions = compare_to_baseline(results, baseline)
+    if regressions:
+        print("Timing regressions:\n" + '\n'.join(regressions))
+        sys.exit(1)
+    print("No timing regressions.")
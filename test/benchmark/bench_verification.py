@@ -0,0 +1,54 @@
+# %% Imports
+import os
+import sys
+import time
+import tempfile
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), r'../..'))
+from markers_analysis import read_trigger_channel, verify_markers
+
+sample_rate = 2000
+hours_list = [1, 3, 6]
+n_channels = 2
+
+
+def gen_recording(path, hours):
+    """
+    Raw recording (int32, 2 channels) with a marker every 200-800 ms in the
+    second channel, recorded with an offset and clock drift, a few markers
+    missing and the trigger value in the lowest 8 bits of the status channel.
+    """
+
+    rng = numpy.random.default_rng(0)
+    n_samples = int(hours * 3600 * sample_rate)
+    n_markers = int(hours * 3600 * 1000 / 500)
+    time_ms = numpy.cumsum(rng.uniform(200, 800, n_markers))
+    values = rng.integers(1, 256, n_markers)
+    samples = numpy.round(((1 + 20e-6) * time_ms - 5000 + rng.normal(0.3, 0.2, n_markers))
+                          * sample_rate / 1000).astype(int)
+    recorded = (samples >= 0) & (samples < n_samples - 20)
+    recorded[rng.choice(n_markers, 10, replace=False)] = False
+
+    data = numpy.zeros((n_samples, n_channels), dtype='<i4')
+    pulse = numpy.add.outer(samples[recorded], numpy.arange(20)).ravel()
+    data[pulse, 1] = numpy.repeat(values[recorded], 20)
+    data[:, 1] |= 0x10000
+    data.tofile(path)
+    return {'time_ms': time_ms, 'value': values}
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as folder:
+        for hours in hours_list:
+            path = os.path.join(folder, 'recording.raw')
+            markers = gen_recording(path, hours)
+            trigger = read_trigger_channel(path, dtype='<i4', n_channels=n_channels, channel=1)
+            t0 = time.perf_counter()
+            result = verify_markers(markers, trigger, sample_rate, mask=0xFF)
+            t_verify = time.perf_counter() - t0
+            summary = result['summary']
+            print(f"{hours} h ({len(trigger) / 1e6:.1f}M samples, {summary['markers']} markers): {t_verify:.2f} s, "
+                  f"{summary['ok']} ok, {summary['missing']} missing, {summary['not_recorded']} not recorded, "
+                  f"{summary['extra']} extra, drift {summary['drift_ppm']:.1f} ppm")
+            del trigger, result
@@ -0,0 +1,148 @@
+# %% Imports
+import os
+import sys
+import json
+import time
+import select
+import termios
+import tty
+import multiprocessing
+import queue
+import serial
+
+plugin_path = os.path.join(os.path.dirname(__file__), r'../../share/opensesame_plugins')
+for plugin in ['markers_os3_init', 'markers_os3_send', 'markers_os3_sequence']:
+    sys.path.insert(0, os.path.abspath(os.path.join(plugin_path, plugin)))
+
+
+class FakeMarkerDevice:
+    """
+    Fake UsbParMarker/Eva on a pseudo terminal (Linux). The device runs in its
+    own process, so the recorded arrival times do not depend on when the
+    benchmark releases the GIL.
+
+    In data mode (115200 baud) marker values are received as single bytes,
+    and the arrival time (perf_counter) of every value is recorded. In
+    command mode (4800 baud) the device answers the V command with its device
+    info (JSON line), which find_device of python_markers uses to identify
+    the device.
+    """
+
+    device_info = {'Version': 'HW1:SW1.0', 'Serialno': 'FAKE0001', 'Device': 'UsbParMarker'}
+
+    def __init__(self):
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._arrivals = []
+        context = multiprocessing.get_context('fork')
+        # The queue buffers the arrivals in the device process, so the device
+        # keeps reading while the benchmark sends markers
+        self._queue = context.Queue()
+        self._stop = context.Event()
+        self._process = context.Process(target=self._serve, name='fake_marker_device', daemon=True)
+
+    def start(self):
+        self._process.start()
+
+    def _serve(self):
+
+        # A real device does not share the CPU with the experiment: with real
+        # time priority (when allowed), the fake device reads a value as soon
+        # as it arrives, also on a machine with few CPU cores
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO)))
+        except (AttributeError, OSError):
+            pass
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            data = os.read(self.master, 4096)
+            arrival = time.perf_counter()
+            if termios.tcgetattr(self.slave)[4] == termios.B4800:
+                if b'V' in data:
+                    os.write(self.master, json.dumps(self.device_info).encode() + b'\n')
+                continue
+            self._queue.put([(arrival, value) for value in data])
+
+    @property
+    def arrivals(self):
+
+        """
+        (arrival time, value) of the marker values received so far.
+        """
+
+        while True:
+            try:
+                self._arrivals += self._queue.get_nowait()
+            except queue.Empty:
+                return self._arrivals
+
+    def wait_for(self, n_values, timeout=5):
+        end = time.perf_counter() + timeout
+        while len(self.arrivals) < n_values and time.perf_counter() < end:
+            time.sleep(0.001)
+        return len(self.arrivals) >= n_values
+
+    def stop(self):
+        self._stop.set()
+        # The device process exits once the arrivals in the queue are read
+        while self._process.is_alive():
+            self.arrivals
+            self._process.join(0.01)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class SerialMarkerManager:
+    """
+    Minimal stand-in for the MarkerManager of python_markers that writes the
+    marker values to a serial port, used to drive the plugin with a fake device
+    when python_markers is not installed.
+    """
+
+    def __init__(self, port):
+        self.serial = serial.Serial(port, baudrate=115200, timeout=1)
+        self.device_properties = {'Device': 'FakeMarkerDevice', 'Port': port}
+
+    def set_value(self, value):
+        self.serial.write(bytes((value,)))
+
+    def close(self):
+        self.serial.close()
+
+
+def marker_manager_name():
+
+    """
+    Returns the marker manager that open_marker_manager uses: python_markers,
+    or serial (SerialMarkerManager) when python_markers is not installed.
+    """
+
+    try:
+        import python_markers
+    except ImportError:
+        return 'serial'
+    return 'python_markers'
+
+
+def open_marker_manager(port, time_function_ms):
+
+    """
+    Opens a marker manager for the fake device on port. With python_markers,
+    the device is found with find_device and driven by its MarkerManager, as
+    in markers_os3_init.run.
+    """
+
+    if marker_manager_name() == 'serial':
+        return SerialMarkerManager(port)
+    from python_markers import marker_management
+    device_info = marker_management.find_device(device_type='UsbParMarker', serial_no='', com_port=port,
+                                                fallback_to_fake=False)
+    return marker_management.MarkerManager(device_type=device_info['device']['Device'],
+                                           device_address=device_info['com_port'],
+                                           crash_on_marker_errors=False,
+                                           time_function_ms=time_function_ms)